@@ -1,6 +1,6 @@
 import json
 from datetime import datetime, timezone
-from typing import Optional
+from typing import Any, Optional, Union
 from unittest import mock
 
 import sseclient
@@ -17,7 +17,6 @@ from jmapc import (
     Envelope,
     Identity,
     Mailbox,
-    MailboxQueryFilterCondition,
     Ref,
     Thread,
 )
@@ -28,33 +27,46 @@ from jmapc.methods import (
     EmailGet,
     EmailGetResponse,
     EmailQuery,
+    EmailQueryResponse,
     EmailSet,
     EmailSetResponse,
     EmailSubmissionSet,
     EmailSubmissionSetResponse,
+    IdentityChanges,
+    IdentityChangesResponse,
+    IdentityGet,
     IdentityGetResponse,
     InvocationResponse,
+    MailboxChanges,
+    MailboxChangesResponse,
     MailboxGet,
     MailboxGetResponse,
-    MailboxQuery,
+    Method,
     Response,
     ThreadGet,
     ThreadGetResponse,
 )
+from jmapc.session import SessionCapabilities, SessionCapabilitiesCore
 from replyowl import version as replyowl_version
 
 from wafflesbot import version as wafflesbot_version
+from wafflesbot.jmap import EMAIL_PROPERTIES
 
 local_tz_abbrev = datetime(1994, 8, 24, 12, 1, 2).astimezone().strftime("%Z")
 
 
 def make_email_event(
-    email_state: str, id: Optional[str] = None
+    email_state: str,
+    id: Optional[str] = None,
+    mailbox_state: Optional[str] = None,
 ) -> sseclient.Event:
+    changed = {"email": email_state}
+    if mailbox_state:
+        changed["mailbox"] = mailbox_state
     return sseclient.Event(
         id=id,
         event="state",
-        data=json.dumps({"changed": {"u1138": {"email": email_state}}}),
+        data=json.dumps({"changed": {"u1138": changed}}),
     )
 
 
@@ -80,49 +92,124 @@ def make_identity_get_response(
     )
 
 
-def make_mailbox_get_call(name: str) -> mock._Call:
-    return mock.call(
-        [
-            MailboxQuery(
-                filter=MailboxQueryFilterCondition(
-                    name=name, role=None, parent_id=None
-                )
-            ),
-            MailboxGet(ids=Ref("/ids")),
-        ],
+def make_mailbox(id: str, name: str, role: Optional[str] = None) -> Mailbox:
+    return Mailbox(
+        id=id,
+        sort_order=50,
+        total_emails=100,
+        unread_emails=50,
+        total_threads=40,
+        unread_threads=3,
+        is_subscribed=True,
+        name=name,
+        role=role,
     )
 
 
-def make_mailbox_get_response(id: str, name: str) -> list[InvocationResponse]:
+def make_metadata_changes_methods() -> list[Method]:
+    return [
+        MailboxChanges(since_state="2187"),
+        MailboxGet(ids=Ref("/created")),
+        MailboxGet(ids=Ref("/updated", method=-2)),
+        IdentityChanges(since_state="2187"),
+        IdentityGet(ids=Ref("/created")),
+        IdentityGet(ids=Ref("/updated", method=-2)),
+    ]
+
+
+def make_metadata_changes_call() -> mock._Call:
+    return mock.call(make_metadata_changes_methods())
+
+
+def make_metadata_changes_response(
+    updated_mailboxes: list[Any],
+) -> list[InvocationResponse]:
+    changes: dict[str, Any] = dict(
+        account_id="u1138",
+        old_state="2187",
+        new_state="2188",
+        has_more_changes=False,
+        created=[],
+        destroyed=[],
+    )
     return [
-        InvocationResponse(id="0.Mailbox/query", response=Response()),
+        InvocationResponse(
+            id="0.Mailbox/changes",
+            response=MailboxChangesResponse(
+                updated=[mailbox.id for mailbox in updated_mailboxes],
+                **changes,
+            ),
+        ),
         InvocationResponse(
             id="1.Mailbox/get",
+            response=MailboxGetResponse(
+                account_id="u1138", state="2188", not_found=[], data=[]
+            ),
+        ),
+        InvocationResponse(
+            id="2.Mailbox/get",
+            response=MailboxGetResponse(
+                account_id="u1138",
+                state="2188",
+                not_found=[],
+                data=updated_mailboxes,
+            ),
+        ),
+        InvocationResponse(
+            id="3.Identity/changes",
+            response=IdentityChangesResponse(updated=[], **changes),
+        ),
+        InvocationResponse(
+            id="4.Identity/get",
+            response=IdentityGetResponse(
+                account_id="u1138", state="2188", not_found=[], data=[]
+            ),
+        ),
+        InvocationResponse(
+            id="5.Identity/get",
+            response=IdentityGetResponse(
+                account_id="u1138", state="2188", not_found=[], data=[]
+            ),
+        ),
+    ]
+
+
+def make_warm_up_call() -> mock._Call:
+    return mock.call([MailboxGet(ids=None), IdentityGet()])
+
+
+def make_warm_up_response(
+    mailboxes: Optional[dict[str, str]] = None,
+    email: str = "ness@onett.example.com",
+) -> list[InvocationResponse]:
+    # Special mailboxes are given roles but other names, so tests show they
+    # are found by role
+    return [
+        InvocationResponse(
+            id="0.Mailbox/get",
             response=MailboxGetResponse(
                 account_id="u1138",
                 state="2187",
                 not_found=[],
                 data=[
-                    Mailbox(
-                        id=id,
-                        sort_order=50,
-                        total_emails=100,
-                        unread_emails=50,
-                        total_threads=40,
-                        unread_threads=3,
-                        is_subscribed=True,
-                        name=name,
-                    )
+                    make_mailbox("MBX1000", "Inbox", role="inbox"),
+                    make_mailbox("MBX1002", "Drafts", role="drafts"),
+                    make_mailbox("MBX1003", "Sent Items", role="sent"),
+                    *(
+                        make_mailbox(id, name)
+                        for id, name in (
+                            mailboxes or {"MBX50": "pigeonhole"}
+                        ).items()
+                    ),
                 ],
             ),
         ),
+        InvocationResponse(
+            id="1.Identity/get", response=make_identity_get_response(email)
+        ),
     ]
 
 
-def make_thread_get_call() -> mock._Call:
-    return mock.call(ThreadGet(ids=["Tbeef1"]))
-
-
 def make_thread_get_response(has_email_id: bool = True) -> ThreadGetResponse:
     return ThreadGetResponse(
         account_id="u1138",
@@ -137,17 +224,28 @@ def make_thread_get_response(has_email_id: bool = True) -> ThreadGetResponse:
     )
 
 
-def make_thread_search_call() -> mock._Call:
+def make_thread_search_call(
+    limit: int = 10,
+    anchor: Optional[str] = None,
+    mailbox_id: str = "MBX50",
+    server_side_filters: bool = True,
+) -> mock._Call:
     return mock.call(
         [
             EmailQuery(
                 collapse_threads=True,
                 filter=EmailQueryFilterCondition(
-                    in_mailbox="MBX50",
+                    in_mailbox=mailbox_id,
                     after=datetime(1994, 8, 17, 12, 1, 2, tzinfo=timezone.utc),
+                    none_in_thread_have_keyword=(
+                        "$answered" if server_side_filters else None
+                    ),
                 ),
                 sort=[Comparator(property="receivedAt", is_ascending=False)],
-                limit=10,
+                position=(None if anchor else 0),
+                anchor=anchor,
+                anchor_offset=(1 if anchor else None),
+                limit=limit,
             ),
             EmailGet(ids=Ref("/ids"), properties=["threadId"]),
             ThreadGet(ids=Ref("/list/*/threadId")),
@@ -155,10 +253,31 @@ def make_thread_search_call() -> mock._Call:
     )
 
 
-def make_thread_search_response() -> list[InvocationResponse]:
+def make_thread_search_response(
+    ids: Optional[list[str]] = None,
+    thread_email_ids: Optional[list[str]] = None,
+) -> list[InvocationResponse]:
+    ids = ["Mdeadbeef"] if ids is None else ids
     return [
-        InvocationResponse(id="0.Email/query", response=Response()),
-        InvocationResponse(id="1.Email/get", response=Response()),
+        InvocationResponse(
+            id="0.Email/query",
+            response=EmailQueryResponse(
+                account_id="u1138",
+                query_state="4000",
+                can_calculate_changes=True,
+                position=0,
+                ids=ids,
+            ),
+        ),
+        InvocationResponse(
+            id="1.Email/get",
+            response=EmailGetResponse(
+                account_id="u1138",
+                state="2187",
+                not_found=[],
+                data=[Email(id=id, thread_id="Tbeef1") for id in ids],
+            ),
+        ),
         InvocationResponse(
             id="2.Thread/get",
             response=ThreadGetResponse(
@@ -168,47 +287,150 @@ def make_thread_search_response() -> list[InvocationResponse]:
                 data=[
                     Thread(
                         id="Tbeef1",
-                        email_ids=[
-                            "Mdeadbeef",
-                        ],
-                    ),
+                        email_ids=(thread_email_ids or ["Mdeadbeef"]),
+                    )
+                    for _ in ids
                 ],
             ),
         ),
     ]
 
 
-def make_email_changes_call(since_state: str) -> mock._Call:
+def make_email_state_call() -> mock._Call:
+    return mock.call(EmailGet(ids=[], properties=["id"]))
+
+
+def make_email_state_response(state: str = "1118") -> EmailGetResponse:
+    return EmailGetResponse(
+        account_id="u1138", state=state, not_found=[], data=[]
+    )
+
+
+def make_email_event_call(
+    since_state: str, metadata_changes: bool = False
+) -> mock._Call:
     return mock.call(
-        EmailChanges(
-            since_state=since_state,
+        [
+            EmailChanges(since_state=since_state, max_changes=256),
+            make_email_get_method(Ref("/created")),
+            ThreadGet(ids=Ref("/list/*/threadId")),
+            *(make_metadata_changes_methods() if metadata_changes else []),
+        ]
+    )
+
+
+def make_email_event_response(
+    email_get_response: EmailGetResponse,
+    thread_get_response: ThreadGetResponse,
+    new_state: str = "2001",
+    has_more_changes: bool = False,
+    created: Optional[list[str]] = None,
+    updated: Optional[list[str]] = None,
+    destroyed: Optional[list[str]] = None,
+) -> list[InvocationResponse]:
+    return [
+        InvocationResponse(
+            id="0.Email/changes",
+            response=make_email_changes_response(
+                new_state=new_state,
+                has_more_changes=has_more_changes,
+                created=created,
+                updated=updated,
+                destroyed=destroyed,
+            ),
         ),
+        InvocationResponse(id="1.Email/get", response=email_get_response),
+        InvocationResponse(id="2.Thread/get", response=thread_get_response),
+    ]
+
+
+def make_email_updated_call(ids: list[str]) -> mock._Call:
+    return mock.call(
+        [
+            make_email_get_method(ids),
+            ThreadGet(ids=Ref("/list/*/threadId")),
+        ],
         raise_errors=True,
     )
 
 
-def make_email_changes_response() -> EmailChangesResponse:
+def make_email_updated_response(
+    email_get_response: EmailGetResponse,
+    thread_get_response: ThreadGetResponse,
+) -> list[InvocationResponse]:
+    return [
+        InvocationResponse(id="0.Email/get", response=email_get_response),
+        InvocationResponse(id="1.Thread/get", response=thread_get_response),
+    ]
+
+
+def make_email_changes_response(
+    new_state: str = "2001",
+    has_more_changes: bool = False,
+    created: Optional[list[str]] = None,
+    updated: Optional[list[str]] = None,
+    destroyed: Optional[list[str]] = None,
+) -> EmailChangesResponse:
     return EmailChangesResponse(
         account_id="u1138",
         old_state="2000",
-        new_state="2001",
-        created=["Mdeadbeef"],
-        updated=[],
-        destroyed=[],
-        has_more_changes=False,
+        new_state=new_state,
+        created=(["Mdeadbeef"] if created is None else created),
+        updated=(updated or []),
+        destroyed=(destroyed or []),
+        has_more_changes=has_more_changes,
     )
 
 
-def make_email_get_call(
-    properties: Optional[list[str]] = None,
-    fetch_all_body_values: Optional[bool] = None,
-) -> mock._Call:
+def make_email_get_method(ids: Union[Ref, list[str]]) -> EmailGet:
+    return EmailGet(ids=ids, properties=EMAIL_PROPERTIES)
+
+
+def make_email_get_call() -> mock._Call:
+    return mock.call([make_email_get_method(["Mdeadbeef"])], raise_errors=True)
+
+
+def make_email_get_results(
+    email_get_response: EmailGetResponse,
+) -> list[InvocationResponse]:
+    return [InvocationResponse(id="0.Email/get", response=email_get_response)]
+
+
+def make_email_body_get_call() -> mock._Call:
     return mock.call(
-        EmailGet(
-            ids=["Mdeadbeef"],
-            fetch_all_body_values=fetch_all_body_values,
-            max_body_value_bytes=(1024**2 if fetch_all_body_values else None),
-            properties=properties,
+        [
+            EmailGet(
+                ids=["Mdeadbeef"],
+                properties=["id", "textBody", "htmlBody", "bodyValues"],
+                body_properties=["partId", "type"],
+                fetch_text_body_values=True,
+                fetch_html_body_values=True,
+                max_body_value_bytes=256 * 1024,
+            )
+        ],
+        raise_errors=True,
+    )
+
+
+def make_email_body_get_response() -> list[InvocationResponse]:
+    return make_email_get_results(
+        make_email_get_response(is_read=False, is_in_inbox=False)
+    )
+
+
+def make_session_capabilities(
+    max_objects_in_get: int = 500, max_calls_in_request: int = 16
+) -> SessionCapabilities:
+    return SessionCapabilities(
+        core=SessionCapabilitiesCore(
+            max_size_upload=50000000,
+            max_concurrent_upload=4,
+            max_size_request=10000000,
+            max_concurrent_requests=4,
+            max_calls_in_request=max_calls_in_request,
+            max_objects_in_get=max_objects_in_get,
+            max_objects_in_set=500,
+            collation_algorithms=set(),
         )
     )
 
@@ -253,110 +475,114 @@ def make_email_get_response(
     )
 
 
-def make_email_send_call() -> mock._Call:
-    return mock.call(
-        [
-            EmailSet(
-                create=dict(
-                    draft=Email(
-                        mail_from=[
-                            EmailAddress(email="ness@onett.example.com")
-                        ],
-                        to=[EmailAddress(email="paula@twoson.example.com")],
-                        subject="Re: Day Trip to Happy Happy Village",
-                        body_values=dict(
-                            text=EmailBodyValue(
-                                value=(
-                                    "**Hi there**. I'm a _test_ message "
-                                    "for unit testing.  \n\n----\n\n"
-                                    "On Wed Aug 24 1994 12:01 "
-                                    f"{local_tz_abbrev}, Paula "
-                                    "<paula@twoson.example.com> wrote:\n\n"
-                                    "> plain_text"
-                                )
-                            ),
-                            html=EmailBodyValue(
-                                value=(
-                                    "<!DOCTYPE html>\n<html><head>"
-                                    "<title></title></head><body>"
-                                    "<b>Hi there</b>. I'm a <i>test</i> "
-                                    "message for unit testing.<br/><div>"
-                                    "On Wed Aug 24 1994 12:01 "
-                                    f"{local_tz_abbrev}, Paula "
-                                    "&lt;paula@twoson.example.com&gt; wrote:"
-                                    "<br/></div><blockquote "
-                                    'style="margin-left: 0.8ex; '
-                                    "padding-left: 2ex; "
-                                    "border-left: 2px solid #aaa; "
-                                    'border-radius: 8px;" type="cite">'
-                                    "<b>html</b> text"
-                                    "</blockquote></body></html>"
-                                )
-                            ),
+def make_email_send_call(
+    archive_method: Optional[EmailSet] = None, creation_id_suffix: str = ""
+) -> mock._Call:
+    methods: list[Method] = [
+        EmailSet(
+            create={
+                f"draft{creation_id_suffix}": Email(
+                    mail_from=[EmailAddress(email="ness@onett.example.com")],
+                    to=[EmailAddress(email="paula@twoson.example.com")],
+                    subject="Re: Day Trip to Happy Happy Village",
+                    body_values=dict(
+                        text=EmailBodyValue(
+                            value=(
+                                "**Hi there**. I'm a _test_ message "
+                                "for unit testing.  \n\n----\n\n"
+                                "On Wed Aug 24 1994 12:01 "
+                                f"{local_tz_abbrev}, Paula "
+                                "<paula@twoson.example.com> wrote:\n\n"
+                                "> plain_text"
+                            )
                         ),
-                        text_body=[
-                            EmailBodyPart(part_id="text", type="text/plain")
-                        ],
-                        html_body=[
-                            EmailBodyPart(part_id="html", type="text/html")
-                        ],
-                        in_reply_to=["first@ness.onett.example.com"],
-                        references=["first@ness.onett.example.com"],
-                        headers=[
-                            EmailHeader(
-                                name="User-Agent",
-                                value=(
-                                    f"wafflesbot/{wafflesbot_version} "
-                                    f"(jmapc {jmapc_version}, "
-                                    f"replyowl {replyowl_version})"
-                                ),
+                        html=EmailBodyValue(
+                            value=(
+                                "<!DOCTYPE html>\n<html><head>"
+                                "<title></title></head><body>"
+                                "<b>Hi there</b>. I'm a <i>test</i> "
+                                "message for unit testing.<br/><div>"
+                                "On Wed Aug 24 1994 12:01 "
+                                f"{local_tz_abbrev}, Paula "
+                                "&lt;paula@twoson.example.com&gt; wrote:"
+                                "<br/></div><blockquote "
+                                'style="margin-left: 0.8ex; '
+                                "padding-left: 2ex; "
+                                "border-left: 2px solid #aaa; "
+                                'border-radius: 8px;" type="cite">'
+                                "<b>html</b> text"
+                                "</blockquote></body></html>"
                             )
-                        ],
-                        message_id=[
-                            (
-                                "1994.08.24T12.01.02"
-                                "@wafflesbot.ness.onett.example.com"
+                        ),
+                    ),
+                    text_body=[
+                        EmailBodyPart(part_id="text", type="text/plain")
+                    ],
+                    html_body=[
+                        EmailBodyPart(part_id="html", type="text/html")
+                    ],
+                    in_reply_to=["first@ness.onett.example.com"],
+                    references=["first@ness.onett.example.com"],
+                    headers=[
+                        EmailHeader(
+                            name="User-Agent",
+                            value=(
+                                f"wafflesbot/{wafflesbot_version} "
+                                f"(jmapc {jmapc_version}, "
+                                f"replyowl {replyowl_version})"
+                            ),
+                        )
+                    ],
+                    message_id=[
+                        (
+                            "1994.08.24T12.01.02"
+                            "@wafflesbot.ness.onett.example.com"
+                        )
+                    ],
+                    keywords={"$draft": True},
+                    mailbox_ids={"MBX1002": True},
+                )
+            }
+        ),
+        EmailSubmissionSet(
+            create={
+                f"emailToSend{creation_id_suffix}": EmailSubmission(
+                    email_id=f"#draft{creation_id_suffix}",
+                    identity_id="ID1",
+                    envelope=Envelope(
+                        mail_from=Address(
+                            email="ness@onett.example.com",
+                            parameters=None,
+                        ),
+                        rcpt_to=[
+                            Address(
+                                email="paula@twoson.example.com",
+                                parameters=None,
                             )
                         ],
-                        keywords={"$draft": True},
-                        mailbox_ids={"MBX1002": True},
-                    )
+                    ),
                 )
-            ),
-            EmailSubmissionSet(
-                create=dict(
-                    emailToSend=EmailSubmission(
-                        email_id="#draft",
-                        identity_id="ID1",
-                        envelope=Envelope(
-                            mail_from=Address(
-                                email="ness@onett.example.com",
-                                parameters=None,
-                            ),
-                            rcpt_to=[
-                                Address(
-                                    email="paula@twoson.example.com",
-                                    parameters=None,
-                                )
-                            ],
-                        ),
-                    )
-                ),
-                on_success_update_email={
-                    "#emailToSend": {
-                        "keywords/$draft": None,
-                        "keywords/$seen": True,
-                        "mailboxIds/MBX1002": None,
-                        "mailboxIds/MBX1003": True,
-                    }
-                },
-            ),
-        ]
-    )
+            },
+            on_success_update_email={
+                f"#emailToSend{creation_id_suffix}": {
+                    "keywords/$draft": None,
+                    "keywords/$seen": True,
+                    "mailboxIds/MBX1002": None,
+                    "mailboxIds/MBX1003": True,
+                }
+            },
+        ),
+    ]
+    if archive_method:
+        methods.append(archive_method)
+    return mock.call(methods)
 
 
-def make_email_send_response() -> list[InvocationResponse]:
-    return [
+def make_email_send_response(
+    archive_response: Optional[EmailSetResponse] = None,
+    creation_id_suffix: str = "",
+) -> list[InvocationResponse]:
+    responses = [
         InvocationResponse(id="0.Email/set", response=Response()),
         InvocationResponse(
             id="1.EmailSubmission/set",
@@ -365,7 +591,7 @@ def make_email_send_response() -> list[InvocationResponse]:
                 old_state="3000",
                 new_state="3001",
                 created={
-                    "emailToSend": EmailSubmission(
+                    f"emailToSend{creation_id_suffix}": EmailSubmission(
                         send_at=datetime.now().astimezone(timezone.utc)
                     )
                 },
@@ -377,26 +603,26 @@ def make_email_send_response() -> list[InvocationResponse]:
             ),
         ),
     ]
+    if archive_response:
+        responses.append(
+            InvocationResponse(id="2.Email/set", response=archive_response)
+        )
+    return responses
 
 
-def make_email_archive_call(
-    is_read: bool, is_in_inbox: bool
-) -> Optional[mock._Call]:
+def make_email_archive_method(is_read: bool, is_in_inbox: bool) -> EmailSet:
     updates: dict[str, Optional[bool]] = {}
     if not is_read:
         updates["keywords/$seen"] = True
+    updates["keywords/$answered"] = True
     if is_in_inbox:
         updates["mailboxIds/MBX1000"] = None
-    if not updates:
-        return None
-    return mock.call(EmailSet(update={"Mdeadbeef": updates}))
+    return EmailSet(update={"Mdeadbeef": updates})
 
 
 def make_email_archive_response(
     is_read: bool, is_in_inbox: bool
-) -> Optional[EmailSetResponse]:
-    if is_read and not is_in_inbox:
-        return None
+) -> EmailSetResponse:
     return EmailSetResponse(
         account_id="u1138",
         old_state="3000",
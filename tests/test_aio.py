@@ -0,0 +1,227 @@
+import asyncio
+import threading
+from collections.abc import Iterable, Iterator
+from typing import Any
+from unittest import mock
+
+import pytest
+import sseclient
+from freezegun import freeze_time
+from jmapc import Email
+from jmapc.session import SessionPrimaryAccount
+
+from wafflesbot.aio import AsyncJMAPClientWrapper, AsyncWaffles
+
+from .method_utils import (
+    make_email_archive_method,
+    make_email_archive_response,
+    make_email_body_get_call,
+    make_email_body_get_response,
+    make_email_event,
+    make_email_event_call,
+    make_email_event_response,
+    make_email_get_call,
+    make_email_get_response,
+    make_email_get_results,
+    make_email_send_call,
+    make_email_send_response,
+    make_email_state_call,
+    make_email_state_response,
+    make_session_capabilities,
+    make_thread_get_response,
+    make_thread_search_call,
+    make_thread_search_response,
+    make_warm_up_call,
+    make_warm_up_response,
+)
+
+
+@pytest.fixture
+def wafflesbot() -> Iterable[AsyncWaffles]:
+    with freeze_time("1994-08-24 12:01:02"):
+        yield AsyncWaffles(
+            host="jmap-example.localhost",
+            api_token="ness__pk_fire",
+            reply_content=(
+                "<b>Hi there</b>. I'm a <i>test</i> message "
+                "for unit testing.<br />"
+            ),
+            newer_than_days=7,
+            mailbox_name="pigeonhole",
+            live_mode=True,
+        )
+
+
+@pytest.fixture
+def mock_request(wafflesbot: AsyncWaffles) -> Iterable[mock.MagicMock]:
+    request_mock = mock.MagicMock()
+    session_mock = mock.MagicMock(
+        primary_accounts=SessionPrimaryAccount(mail="u1138"),
+        event_source_url="https://jmap-example.localhost/events/",
+        capabilities=make_session_capabilities(),
+    )
+    with (
+        mock.patch("jmapc.client.Client.jmap_session", session_mock),
+        mock.patch.object(wafflesbot.client, "request", request_mock),
+    ):
+        yield request_mock
+
+
+@pytest.fixture(autouse=True)
+def mock_events(wafflesbot: AsyncWaffles) -> Iterable[list[sseclient.Event]]:
+    mock_events_data: list[sseclient.Event] = []
+    with mock.patch.object(wafflesbot.client, "_events", mock_events_data):
+        yield mock_events_data
+
+
+@pytest.mark.parametrize(
+    "events", [True, False], ids=["events", "script_mode"]
+)
+def test_async_wafflesbot(
+    wafflesbot: AsyncWaffles,
+    mock_request: mock.MagicMock,
+    mock_events: list[sseclient.Event],
+    events: bool,
+) -> None:
+    mock_events.append(make_email_event(email_state="1118"))
+    mock_events.append(make_email_event(email_state="1119"))
+    expected_calls: list[mock._Call] = [make_warm_up_call()]
+    mock_responses: list[Any] = [make_warm_up_response()]
+    if events:
+        expected_calls.append(make_email_state_call())
+        mock_responses.append(make_email_state_response())
+        expected_calls.append(make_email_event_call(since_state="1118"))
+        mock_responses.append(
+            make_email_event_response(
+                make_email_get_response(
+                    is_read=True, is_in_inbox=True, additional_mailbox="MBX50"
+                ),
+                make_thread_get_response(),
+            )
+        )
+    else:
+        expected_calls.append(make_thread_search_call())
+        expected_calls.append(make_email_get_call())
+        mock_responses.append(make_thread_search_response())
+        mock_responses.append(
+            make_email_get_results(
+                make_email_get_response(is_read=True, is_in_inbox=True)
+            )
+        )
+    expected_calls.extend(
+        [
+            make_email_body_get_call(),
+            make_email_send_call(
+                archive_method=make_email_archive_method(
+                    is_read=True, is_in_inbox=True
+                )
+            ),
+        ]
+    )
+    mock_responses.extend(
+        [
+            make_email_body_get_response(),
+            make_email_send_response(
+                archive_response=make_email_archive_response(
+                    is_read=True, is_in_inbox=True
+                )
+            ),
+        ]
+    )
+    mock_request.side_effect = mock_responses
+    asyncio.run(wafflesbot.run_async(events=events))
+    assert mock_request.call_args_list == expected_calls
+
+
+def test_async_slow_reply_does_not_block_events() -> None:
+    released = threading.Event()
+    replied: list[str] = []
+
+    def reply(email: Email) -> None:
+        assert released.wait(timeout=5)
+        assert email.id
+        replied.append(email.id)
+
+    client = AsyncJMAPClientWrapper(
+        "jmap-example.localhost",
+        mailbox_name="pigeonhole",
+        new_email_callback=reply,
+    )
+    handled: list[str] = []
+
+    def handle_event(all_prev_state: Any, event: Any) -> None:
+        handled.append(event)
+        if len(handled) == 1:
+            assert client._process_emails([Email(id="M1")]) == 1
+        else:
+            released.set()
+
+    with (
+        mock.patch.object(client, "_start_events", return_value={}),
+        mock.patch.object(client, "_handle_event", handle_event),
+        mock.patch.object(AsyncJMAPClientWrapper, "events", ["E1", "E2"]),
+    ):
+        asyncio.run(client.process_events_async())
+    assert handled == ["E1", "E2"]
+    assert replied == ["M1"]
+
+
+def test_async_slow_body_fetch_does_not_block_events() -> None:
+    released = threading.Event()
+    replied: list[str] = []
+
+    def with_bodies(emails: list[Email]) -> list[Email]:
+        assert released.wait(timeout=5)
+        return emails
+
+    def reply(email: Email) -> None:
+        assert email.id
+        replied.append(email.id)
+
+    client = AsyncJMAPClientWrapper(
+        "jmap-example.localhost",
+        mailbox_name="pigeonhole",
+        new_email_callback=reply,
+    )
+    handled: list[str] = []
+
+    def handle_event(all_prev_state: Any, event: Any) -> None:
+        handled.append(event)
+        if len(handled) == 1:
+            assert client._reply_to_emails([Email(id="M1")]) == 1
+        else:
+            released.set()
+
+    with (
+        mock.patch.object(client, "_start_events", return_value={}),
+        mock.patch.object(client, "_handle_event", handle_event),
+        mock.patch.object(client, "_with_bodies", with_bodies),
+        mock.patch.object(AsyncJMAPClientWrapper, "events", ["E1", "E2"]),
+    ):
+        asyncio.run(client.process_events_async())
+    assert handled == ["E1", "E2"]
+    assert replied == ["M1"]
+
+
+def test_async_event_stream_error() -> None:
+    client = AsyncJMAPClientWrapper(
+        "jmap-example.localhost",
+        mailbox_name="pigeonhole",
+        new_email_callback=mock.MagicMock(),
+    )
+    handled: list[str] = []
+
+    def events() -> Iterator[str]:
+        yield "E1"
+        raise Exception("Event stream closed")
+
+    with (
+        mock.patch.object(client, "_start_events", return_value={}),
+        mock.patch.object(
+            client, "_handle_event", lambda _, event: handled.append(event)
+        ),
+        mock.patch.object(client, "_coalesced_events", events),
+        pytest.raises(Exception, match="Event stream closed"),
+    ):
+        asyncio.run(client.process_events_async())
+    assert handled == ["E1"]
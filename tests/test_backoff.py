@@ -0,0 +1,20 @@
+import time
+
+import pytest
+
+from wafflesbot.backoff import Backoff
+
+
+def test_backoff(monkeypatch: pytest.MonkeyPatch) -> None:
+    clock = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    backoff = Backoff()
+    assert [backoff.fail() for _ in range(3)] == [1.0, 2.0, 4.0]
+    for _ in range(10):
+        backoff.fail()
+    assert backoff.fail() == Backoff.MAX_DELAY
+    # Running for as long as the longest wait starts over
+    backoff.start()
+    clock[0] += Backoff.MAX_DELAY + 1
+    assert backoff.fail() == 1.0
+    assert backoff.failures == 1
@@ -0,0 +1,42 @@
+import threading
+from unittest import mock
+
+from jmapc import Email
+
+from wafflesbot.batch import ReplyBatcher
+from wafflesbot.jmap import Reply
+
+
+def make_reply(email_id: str) -> Reply:
+    return Reply(email=Email(id=email_id), text_body="text")
+
+
+def test_batch_flush_when_full() -> None:
+    send = mock.MagicMock()
+    batcher = ReplyBatcher(send, max_size=2)
+    batcher.add(make_reply("M1"))
+    send.assert_not_called()
+    batcher.add(make_reply("M2"))
+    send.assert_called_once_with([make_reply("M1"), make_reply("M2")])
+    assert len(batcher) == 0
+    batcher.flush()
+    send.assert_called_once()
+
+
+def test_batch_flush_after_window() -> None:
+    sent = threading.Event()
+    send = mock.MagicMock(side_effect=lambda replies: sent.set())
+    batcher = ReplyBatcher(send, max_size=10, window=0.01)
+    batcher.add(make_reply("M1"))
+    assert sent.wait(timeout=5)
+    send.assert_called_once_with([make_reply("M1")])
+    assert len(batcher) == 0
+
+
+def test_batch_flush() -> None:
+    send = mock.MagicMock()
+    batcher = ReplyBatcher(send, max_size=10, window=60)
+    batcher.add(make_reply("M1"))
+    batcher.add(make_reply("M2"))
+    batcher.flush()
+    send.assert_called_once_with([make_reply("M1"), make_reply("M2")])
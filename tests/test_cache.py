@@ -0,0 +1,156 @@
+import threading
+import time
+from typing import Any
+from unittest import mock
+
+from jmapc.errors import CannotCalculateChanges
+from jmapc.methods import IdentityGet, InvocationResponseOrError, MailboxGet
+
+from wafflesbot.cache import MetadataCache, ThreadCache
+
+from .method_utils import (
+    make_mailbox,
+    make_metadata_changes_call,
+    make_metadata_changes_methods,
+    make_metadata_changes_response,
+    make_warm_up_response,
+)
+
+
+def test_thread_cache() -> None:
+    cache = ThreadCache()
+    cache.add("T1", ["M1", "M2"])
+    assert cache.thread_for_email("M1") == "T1"
+    assert cache.thread_for_email("M2") == "T1"
+    assert cache.thread_for_email("M3") is None
+    cache.add("T1", ["M1", "M2", "M3"])
+    assert cache.thread_for_email("M3") == "T1"
+    assert len(cache) == 1
+
+
+def test_thread_cache_discard() -> None:
+    cache = ThreadCache()
+    cache.add("T1", ["M1", "M2"])
+    cache.discard_email("M2")
+    assert cache.thread_for_email("M1") is None
+    assert len(cache) == 0
+
+
+def test_thread_cache_evicts_least_recently_used() -> None:
+    cache = ThreadCache(max_size=2)
+    cache.add("T1", ["M1"])
+    cache.add("T2", ["M2"])
+    assert cache.thread_for_email("M1") == "T1"
+    cache.add("T3", ["M3"])
+    assert cache.thread_for_email("M1") == "T1"
+    assert cache.thread_for_email("M2") is None
+    assert cache.thread_for_email("M3") == "T3"
+    assert len(cache) == 2
+
+
+def test_metadata_cache() -> None:
+    client = mock.MagicMock()
+    client.request.side_effect = [make_warm_up_response()]
+    cache = MetadataCache(client)
+    inbox = cache.mailbox_by_role("inbox")
+    assert inbox and inbox.id == "MBX1000"
+    pigeonhole = cache.mailbox_by_name("pigeonhole")
+    assert pigeonhole and pigeonhole.id == "MBX50"
+    assert cache.mailbox_by_name("Sent") is None
+    identity = cache.identity_by_email("ness@onett.example.com")
+    assert identity and identity.id == "ID1"
+    assert [identity.id for identity in cache.identities()] == ["ID1"]
+    assert client.request.call_count == 1
+
+
+def test_metadata_cache_single_load() -> None:
+    def request(methods: Any) -> Any:
+        time.sleep(0.1)
+        return make_warm_up_response()
+
+    client = mock.MagicMock()
+    client.request.side_effect = request
+    cache = MetadataCache(client)
+    threads = [
+        threading.Thread(target=cache.mailbox_by_name, args=("pigeonhole",))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert client.request.call_count == 1
+
+
+def test_metadata_cache_pushed_changes() -> None:
+    client = mock.MagicMock()
+    renamed = make_mailbox("MBX50", "pigeonhole-archive")
+    client.request.side_effect = [
+        make_warm_up_response(),
+        make_metadata_changes_response([renamed]),
+    ]
+    cache = MetadataCache(client)
+    cache.load()
+    cache.mailboxes_changed("2187")
+    assert cache.mailbox_by_name("pigeonhole")
+    cache.mailboxes_changed("2188")
+    assert cache.mailbox_by_name("pigeonhole") is None
+    assert cache.mailbox_by_name("pigeonhole-archive") == renamed
+    assert cache.identity_by_email("ness@onett.example.com")
+    assert client.request.call_args_list == [
+        mock.call([MailboxGet(ids=None), IdentityGet()]),
+        make_metadata_changes_call(),
+    ]
+
+
+def test_metadata_cache_expired() -> None:
+    client = mock.MagicMock()
+    client.request.side_effect = [
+        make_warm_up_response(),
+        make_metadata_changes_response([]),
+    ]
+    cache = MetadataCache(client, ttl=0)
+    cache.load()
+    assert cache.mailbox_by_name("pigeonhole")
+    assert client.request.call_args_list[1] == make_metadata_changes_call()
+
+
+def test_metadata_cache_cannot_calculate_changes() -> None:
+    client = mock.MagicMock()
+    client.request.side_effect = [
+        make_warm_up_response(),
+        [
+            InvocationResponseOrError(
+                id="0.Mailbox/changes", response=CannotCalculateChanges()
+            )
+        ],
+        make_warm_up_response(mailboxes={"MBX51": "pigeonhole-eu"}),
+    ]
+    cache = MetadataCache(client)
+    cache.load()
+    cache.mailboxes_changed("2190")
+    assert cache.mailbox_by_name("pigeonhole") is None
+    assert cache.mailbox_by_name("pigeonhole-eu")
+    assert client.request.call_count == 3
+
+
+def test_metadata_cache_update_methods() -> None:
+    client = mock.MagicMock()
+    client.request.side_effect = [
+        make_warm_up_response(),
+        make_warm_up_response(mailboxes={"MBX51": "pigeonhole-eu"}),
+    ]
+    cache = MetadataCache(client)
+    cache.load()
+    assert cache.update_methods() == []
+    cache.mailboxes_changed("2188")
+    assert cache.update_methods() == make_metadata_changes_methods()
+    cache.apply_update(
+        [
+            InvocationResponseOrError(
+                id="0.Mailbox/changes", response=CannotCalculateChanges()
+            )
+        ]
+    )
+    assert cache.mailbox_by_name("pigeonhole-eu")
+    assert client.request.call_count == 2
@@ -1,4 +1,12 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from unittest import mock
+
 import jmapc
+from jmapc.api import APIRequest
+from jmapc.methods import CoreEcho
+from requests.adapters import HTTPAdapter
 
 from wafflesbot.jmap import JMAPClientWrapper
 
@@ -11,3 +19,56 @@ def test_client() -> None:
         new_email_callback=lambda email: None,
     )
     assert isinstance(c, jmapc.Client)
+
+
+def test_client_connection_pool() -> None:
+    c = JMAPClientWrapper.create_with_api_token(
+        host="jmap-api.example.net",
+        api_token="ness__pk_fire",
+        mailbox_name="pigeonhole",
+        new_email_callback=lambda email: None,
+        max_connections=3,
+    )
+    adapter = c.requests_session.get_adapter(
+        "https://jmap-api.example.net/jmap/api/"
+    )
+    assert isinstance(adapter, HTTPAdapter)
+    assert adapter.poolmanager.connection_pool_kw["maxsize"] == 3
+    assert adapter.poolmanager.connection_pool_kw["block"]
+
+
+def test_client_session_invalidated_once() -> None:
+    c = JMAPClientWrapper.create_with_api_token(
+        host="jmap-api.example.net",
+        api_token="ness__pk_fire",
+        mailbox_name="pigeonhole",
+        new_email_callback=lambda email: None,
+    )
+    session = mock.MagicMock(
+        api_url="https://jmap-api.example.net/jmap/api/", state="old"
+    )
+    c.__dict__["jmap_session"] = session
+    posted = threading.Barrier(8, timeout=5)
+
+    def post(*args: Any, **kwargs: Any) -> mock.MagicMock:
+        # Hold every request until all have been sent with the old session
+        posted.wait()
+        return mock.MagicMock(
+            **{
+                "json.return_value": {
+                    "methodResponses": [],
+                    "sessionState": "new",
+                }
+            }
+        )
+
+    request = APIRequest.from_calls("u1138", [CoreEcho()])
+    with (
+        mock.patch.object(c.requests_session, "post", side_effect=post),
+        ThreadPoolExecutor(max_workers=8) as executor,
+    ):
+        results = list(
+            executor.map(lambda _: c._api_request(request), range(8))
+        )
+    assert results == [[]] * 8
+    assert "jmap_session" not in c.__dict__
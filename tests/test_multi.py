@@ -0,0 +1,173 @@
+import json
+import threading
+import time
+from collections.abc import Iterator, Sequence
+from pathlib import Path
+from typing import Any, Optional
+from unittest import mock
+
+import pytest
+from requests.adapters import HTTPAdapter
+
+from wafflesbot.backoff import Backoff
+from wafflesbot.jmap import JMAPClientWrapper
+from wafflesbot.multi import MultiWaffles, load_accounts
+from wafflesbot.transport import MAX_CONNECTIONS
+
+
+def test_load_accounts(tmp_path: Path) -> None:
+    (tmp_path / "token").write_text("ness__pk_fire\n")
+    (tmp_path / "reply.html").write_text("<b>Hi there</b>")
+    path = tmp_path / "accounts.json"
+    path.write_text(
+        json.dumps(
+            [
+                {
+                    "host": "jmap-example.localhost",
+                    "api_token_file": str(tmp_path / "token"),
+                    "mailbox": "pigeonhole",
+                    "reply_content_file": str(tmp_path / "reply.html"),
+                },
+                {
+                    "name": "paula",
+                    "host": "jmap-example.localhost",
+                    "api_token": "paula__pk_freeze",
+                    "mailbox": "pigeonhole",
+                    "reply_content": "Hello",
+                    "state_file": str(tmp_path / "paula.json"),
+                },
+            ]
+        )
+    )
+    accounts = load_accounts(path)
+    assert [account.label for account in accounts] == [
+        "jmap-example.localhost/pigeonhole",
+        "paula",
+    ]
+    assert accounts[0].api_token == "ness__pk_fire"
+    assert accounts[0].reply_content == "<b>Hi there</b>"
+    assert accounts[1].state_file == str(tmp_path / "paula.json")
+
+
+def test_load_accounts_duplicate(tmp_path: Path) -> None:
+    account = {
+        "host": "jmap-example.localhost",
+        "api_token": "ness__pk_fire",
+        "mailbox": "pigeonhole",
+        "reply_content": "Hello",
+    }
+    path = tmp_path / "accounts.json"
+    path.write_text(json.dumps([account, account]))
+    with pytest.raises(AssertionError):
+        load_accounts(path)
+
+
+def _write_accounts(
+    path: Path, names: Sequence[str], host: Optional[str] = None
+) -> Path:
+    path.write_text(
+        json.dumps(
+            [
+                {
+                    "name": name,
+                    "host": host or f"jmap-{name}.localhost",
+                    "api_token": f"{name}__token",
+                    "mailbox": "pigeonhole",
+                    "reply_content": "Hello",
+                }
+                for name in names
+            ]
+        )
+    )
+    return path
+
+
+def test_multi_shares_connection_pool(tmp_path: Path) -> None:
+    path = _write_accounts(
+        tmp_path / "accounts.json",
+        ["ness", "paula"],
+        host="jmap-example.localhost",
+    )
+    multi = MultiWaffles(load_accounts(path))
+    ness, paula = multi.bots["ness"], multi.bots["paula"]
+    assert ness.client is not paula.client
+    url = "https://jmap-example.localhost/jmap/api/"
+    adapter = ness.client.requests_session.get_adapter(url)
+    assert adapter is paula.client.requests_session.get_adapter(url)
+    assert adapter is multi.adapters["jmap-example.localhost"]
+    assert isinstance(adapter, HTTPAdapter)
+    assert (
+        adapter.poolmanager.connection_pool_kw["maxsize"]
+        == 2 * MAX_CONNECTIONS
+    )
+    assert ness.client.requests_session.auth != (
+        paula.client.requests_session.auth
+    )
+
+
+def test_multi_run(tmp_path: Path) -> None:
+    path = _write_accounts(tmp_path / "accounts.json", ["ness", "paula"])
+    multi = MultiWaffles(load_accounts(path))
+    with (
+        mock.patch.object(
+            multi.bots["ness"], "run", side_effect=Exception("boom")
+        ),
+        mock.patch.object(multi.bots["paula"], "run") as paula_run,
+    ):
+        multi.run(limit=5, events=False)
+    paula_run.assert_called_once_with(limit=5, events=False)
+
+
+def test_multi_restarts_failed_accounts(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    monkeypatch.setattr(Backoff, "DELAY", 0.01)
+    multi = MultiWaffles(
+        load_accounts(_write_accounts(tmp_path / "accounts.json", ["ness"]))
+    )
+    with mock.patch.object(
+        multi.bots["ness"],
+        "run",
+        side_effect=[Exception("boom"), Exception("boom"), None],
+    ) as ness_run:
+        multi.run(events=True)
+    assert ness_run.call_count == 3
+    assert "restarting in 0s after 2 failures" in caplog.text
+
+
+class _BlockingEvents:
+    # Events that never arrive, until the test finishes
+    def __init__(self) -> None:
+        self.done = threading.Event()
+
+    def __iter__(self) -> Iterator[Any]:
+        self.done.wait(timeout=5)
+        yield from ()
+
+
+def test_multi_stop(tmp_path: Path) -> None:
+    multi = MultiWaffles(
+        load_accounts(
+            _write_accounts(tmp_path / "accounts.json", ["ness", "paula"])
+        ),
+        workers=1,
+    )
+    events = _BlockingEvents()
+    thread = threading.Thread(target=multi.run)
+    with (
+        mock.patch.object(JMAPClientWrapper, "_start_events", return_value={}),
+        mock.patch.object(JMAPClientWrapper, "events", events),
+    ):
+        thread.start()
+        while any(bot.client._received is None for bot in multi.bots.values()):
+            time.sleep(0.01)
+        multi.stop()
+        thread.join(timeout=1)
+        stopped = not thread.is_alive()
+        events.done.set()
+    assert stopped
+    for bot in multi.bots.values():
+        assert bot.workers is not None
+        assert not bot.workers._threads
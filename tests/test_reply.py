@@ -0,0 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from jmapc import EmailBodyValue
+from replyowl import ReplyOwl
+
+from wafflesbot.reply import ReplyComposer, compose_reply
+
+from .method_utils import make_email_get_response
+
+
+def test_reply_composer() -> None:
+    email = make_email_get_response(is_read=False, is_in_inbox=True).data[0]
+    composer = ReplyComposer("<b>Hi there</b>")
+    with mock.patch.object(
+        ReplyOwl, "html_to_text", autospec=True, return_value="text"
+    ) as html_to_text:
+        assert composer.compose(email) == composer.compose(email)
+    html_to_text.assert_not_called()
+    assert composer.compose(email) == compose_reply(email, "<b>Hi there</b>")
+    assert composer.compose(email)[2] is composer.user_agent
+
+
+def test_reply_truncated_quote() -> None:
+    email = make_email_get_response(is_read=False, is_in_inbox=True).data[0]
+    assert email.body_values
+    email.body_values = {
+        "1": EmailBodyValue(value="plain", is_truncated=True),
+        "2": EmailBodyValue(value="<b>ht", is_truncated=True),
+    }
+    text_body, html_body, _ = ReplyComposer("Hi").compose(email)
+    assert text_body.endswith("> plain\n> [...]")
+    assert html_body and "plain<br/>[...]" in html_body
+    assert "<b>ht" not in html_body
+
+
+def test_reply_composer_threads() -> None:
+    email = make_email_get_response(is_read=False, is_in_inbox=True).data[0]
+    assert email.html_body
+    email.text_body = None
+    email.body_values = {
+        "2": EmailBodyValue(
+            value="<p>Hello <b>there</b>, how are you?</p>" * 20
+        ),
+    }
+    composer = ReplyComposer("<b>Hi there</b>")
+    expected = composer.compose(email)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(
+            executor.map(lambda _: composer.compose(email), range(64))
+        )
+    assert results == [expected] * 64
@@ -0,0 +1,30 @@
+import json
+from pathlib import Path
+
+from wafflesbot.state import StateCheckpoint
+
+
+def test_checkpoint_save_and_load(tmp_path: Path) -> None:
+    path = tmp_path / "state.json"
+    checkpoint = StateCheckpoint(path)
+    assert checkpoint.get("u1138") is None
+    checkpoint.set("u1138", "2001")
+    assert checkpoint.get("u1138") == "2001"
+    assert not path.exists()
+    checkpoint.save()
+    assert json.loads(path.read_text()) == {"u1138": "2001"}
+    assert StateCheckpoint(path).get("u1138") == "2001"
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_checkpoint_save_interval(tmp_path: Path) -> None:
+    path = tmp_path / "state.json"
+    checkpoint = StateCheckpoint(path, save_interval=0)
+    checkpoint.set("u1138", "2001")
+    assert json.loads(path.read_text()) == {"u1138": "2001"}
+
+
+def test_checkpoint_invalid(tmp_path: Path) -> None:
+    path = tmp_path / "state.json"
+    path.write_text("{")
+    assert StateCheckpoint(path).get("u1138") is None
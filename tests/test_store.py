@@ -0,0 +1,45 @@
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+from wafflesbot.store import ReplyStore
+
+
+def test_reply_store(tmp_path: Path) -> None:
+    store = ReplyStore(tmp_path / "replies.db")
+    store.add(
+        "Tbeef1",
+        message_id="first@ness.onett.example.com",
+        reply_message_id="reply@wafflesbot.ness.onett.example.com",
+        submission_id="S1",
+    )
+    assert store.replied_thread_ids(["Tbeef1", "Tbeef2"]) == {"Tbeef1"}
+    assert store.replied_message_ids(
+        ["first@ness.onett.example.com", "second@ness.onett.example.com"]
+    ) == {"first@ness.onett.example.com"}
+    assert store.replied_thread_ids([]) == set()
+    store.close()
+    store = ReplyStore(tmp_path / "replies.db")
+    assert store.replied_thread_ids(["Tbeef1"]) == {"Tbeef1"}
+
+
+def test_reply_store_many_ids(tmp_path: Path) -> None:
+    store = ReplyStore(tmp_path / "replies.db")
+    for i in range(0, 1200, 100):
+        store.add(f"T{i}")
+    assert store.replied_thread_ids(f"T{i}" for i in range(1200)) == {
+        f"T{i}" for i in range(0, 1200, 100)
+    }
+
+
+def test_reply_store_compact(tmp_path: Path) -> None:
+    store = ReplyStore(
+        tmp_path / "replies.db",
+        retention=timedelta(days=1),
+        compact_interval=2,
+    )
+    with mock.patch("time.time", return_value=1000.0):
+        store.add("Tbeef1")
+    assert store.replied_thread_ids(["Tbeef1"]) == {"Tbeef1"}
+    store.add("Tbeef2")
+    assert store.replied_thread_ids(["Tbeef1", "Tbeef2"]) == {"Tbeef2"}
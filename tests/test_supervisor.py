@@ -0,0 +1,115 @@
+import multiprocessing
+import time
+from pathlib import Path
+from typing import Any
+from unittest import mock
+
+import pytest
+
+from wafflesbot import supervisor
+from wafflesbot.backoff import Backoff
+from wafflesbot.multi import AccountConfig
+from wafflesbot.supervisor import HashRing, Supervisor
+
+
+def make_accounts(count: int) -> list[AccountConfig]:
+    return [
+        AccountConfig(
+            host="jmap-example.localhost",
+            api_token=f"token{i}",
+            mailbox="pigeonhole",
+            name=f"account{i}",
+        )
+        for i in range(count)
+    ]
+
+
+def test_hash_ring_moves_only_removed_node_keys() -> None:
+    keys = [f"account{i}" for i in range(200)]
+    before = HashRing(range(4))
+    after = HashRing(range(3))
+    assignments = {key: before.node_for(key) for key in keys}
+    assert set(assignments.values()) == {0, 1, 2, 3}
+    for key, node in assignments.items():
+        if node != 3:
+            assert after.node_for(key) == node
+
+
+def test_supervisor_shards() -> None:
+    accounts = make_accounts(20)
+    shards = Supervisor(accounts, processes=3).shards()
+    assert sorted(label for s in shards.values() for label in s) == sorted(
+        account.label for account in accounts
+    )
+    assert set(shards) <= {0, 1, 2}
+
+
+def _record_shard(
+    accounts: list[AccountConfig],
+    kwargs: dict[str, Any],
+    limit: int,
+    events: bool,
+) -> None:
+    path = Path(kwargs["output"]) / multiprocessing.current_process().name
+    path.write_text(",".join(account.label for account in accounts))
+
+
+@pytest.mark.skipif(
+    multiprocessing.get_start_method() != "fork",
+    reason="Requires forked worker processes",
+)
+def test_supervisor_run_script_mode(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(supervisor, "_run_shard", _record_shard)
+    monkeypatch.setattr(Supervisor, "POLL_INTERVAL", 0.01)
+    accounts = make_accounts(10)
+    s = Supervisor(accounts, processes=2, output=str(tmp_path))
+    s.run(events=False)
+    labels = [
+        label
+        for path in tmp_path.iterdir()
+        for label in path.read_text().split(",")
+    ]
+    assert sorted(labels) == sorted(account.label for account in accounts)
+    assert {path.name for path in tmp_path.iterdir()} == {
+        f"worker-{index}" for index in s.shards()
+    }
+
+
+def test_supervisor_backs_off_restarts(
+    monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture
+) -> None:
+    s = Supervisor(make_accounts(1), processes=1)
+    started: list[int] = []
+    process = mock.MagicMock(exitcode=1)
+    process.is_alive.return_value = False
+
+    def start(index: int, labels: list[str], limit: int, events: bool) -> None:
+        started.append(index)
+        s._workers[index] = (labels, process)
+
+    clock = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(s, "_start", start)
+    for now, restarted in (
+        (1000.0, True),
+        # Exits are found on the next poll, and restarted after 1s
+        (1000.5, False),
+        (1001.5, True),
+        (1001.6, False),
+        (1003.0, False),
+        (1003.6, True),
+        (1003.7, False),
+        (1007.0, False),
+        (1007.7, True),
+    ):
+        clock[0] = now
+        count = len(started)
+        s._reconcile(limit=0, events=True)
+        assert (len(started) > count) == restarted, now
+    assert "restarting in 4s after 3 failures" in caplog.text
+    # A worker that ran for long enough starts over from the shortest wait
+    clock[0] += Backoff.MAX_DELAY + 1
+    s._reconcile(limit=0, events=True)
+    assert s._backoffs[0].failures == 1
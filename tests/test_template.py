@@ -0,0 +1,58 @@
+import pytest
+from jmapc import Email, EmailAddress
+from replyowl import ReplyOwl
+
+from wafflesbot.reply import ReplyComposer
+from wafflesbot.template import ReplyTemplate
+
+from .method_utils import make_email_get_response
+
+
+def test_template_render() -> None:
+    email = Email(
+        mail_from=[EmailAddress(name="Paula", email="paula@example.com")],
+        subject="Tea & <Cookies>",
+    )
+    template = ReplyTemplate("<p>Hi {{sender_name}}, re: {{ subject }}</p>")
+    assert (
+        template.render(email)
+        == "<p>Hi Paula, re: Tea &amp; &lt;Cookies&gt;</p>"
+    )
+    assert ReplyTemplate("{{ subject }}", escape=False).render(email) == (
+        "Tea & <Cookies>"
+    )
+    assert ReplyTemplate("Hi {{ sender_name }}").render(Email()) == "Hi "
+
+
+def test_template_static() -> None:
+    assert ReplyTemplate("<b>Hi</b>").render(Email()) == "<b>Hi</b>"
+
+
+def test_template_unknown_placeholder() -> None:
+    with pytest.raises(Exception, match="password"):
+        ReplyTemplate("{{ password }}")
+
+
+def test_template_convert() -> None:
+    email = Email(
+        mail_from=[EmailAddress(name=None, email="paula@example.com")]
+    )
+    template = ReplyTemplate("<p>Hi <b>{{ sender_name }}</b></p>")
+    text_template = template.convert(ReplyOwl().html_to_text)
+    assert text_template.render(email) == ReplyOwl().html_to_text(
+        "<p>Hi <b>paula@example.com</b></p>"
+    )
+
+
+def test_reply_composer_template() -> None:
+    email = make_email_get_response(is_read=False, is_in_inbox=True).data[0]
+    composer = ReplyComposer("<p>Hi <b>{{ sender_name }}</b></p>")
+    text_body, html_body, _ = composer.compose(email)
+    expected_text, expected_html = ReplyOwl().compose_reply(
+        content="<p>Hi <b>Paula</b></p>",
+        quote_html="<b>html</b> text",
+        quote_text="plain_text",
+        quote_attribution=text_body.split("\n\n")[2],
+    )
+    assert text_body == expected_text
+    assert html_body == expected_html
@@ -0,0 +1,101 @@
+import importlib
+from unittest import mock
+
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+
+from wafflesbot.transport import MAX_CONNECTIONS, HTTP2Adapter, make_adapter
+
+
+def test_make_adapter() -> None:
+    adapter = make_adapter()
+    assert isinstance(adapter, HTTPAdapter)
+    assert adapter.poolmanager.connection_pool_kw["maxsize"] == MAX_CONNECTIONS
+    assert adapter.poolmanager.connection_pool_kw["block"]
+    adapter = make_adapter(4)
+    assert isinstance(adapter, HTTPAdapter)
+    assert adapter.poolmanager.connection_pool_kw["maxsize"] == 4
+
+
+def test_make_adapter_http2() -> None:
+    pytest.importorskip("h2")
+    httpx = pytest.importorskip("httpx")
+    adapter = make_adapter(4, http2=True)
+    assert isinstance(adapter, HTTP2Adapter)
+    assert isinstance(adapter._client, httpx.Client)
+    adapter.close()
+
+
+def test_make_adapter_http2_unavailable() -> None:
+    with (
+        mock.patch.object(importlib, "import_module", side_effect=ImportError),
+        pytest.raises(Exception, match="HTTP/2 requires httpx"),
+    ):
+        make_adapter(http2=True)
+
+
+def test_http2_adapter_send() -> None:
+    httpx = mock.MagicMock()
+    httpx.Client.return_value.request.return_value = mock.MagicMock(
+        status_code=200,
+        headers={"Content-Type": "application/json"},
+        content=b'{"methodResponses": []}',
+        encoding="utf-8",
+        url="https://jmap-example.localhost/jmap/api/",
+        reason_phrase="OK",
+    )
+    with mock.patch.object(importlib, "import_module", return_value=httpx):
+        adapter = make_adapter(4, http2=True)
+    httpx.Client.assert_called_once_with(
+        http2=True, limits=httpx.Limits.return_value
+    )
+    httpx.Limits.assert_called_once_with(
+        max_connections=4, max_keepalive_connections=4
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    r = session.post(
+        "https://jmap-example.localhost/jmap/api/",
+        headers={"Content-Type": "application/json"},
+        data='{"using": []}',
+        timeout=30,
+    )
+    r.raise_for_status()
+    assert r.json() == {"methodResponses": []}
+    assert r.headers["content-type"] == "application/json"
+    assert r.url == "https://jmap-example.localhost/jmap/api/"
+    assert r.reason == "OK"
+    request = httpx.Client.return_value.request
+    request.assert_called_once_with(
+        "POST",
+        "https://jmap-example.localhost/jmap/api/",
+        headers=mock.ANY,
+        content='{"using": []}',
+        timeout=httpx.Timeout.return_value,
+    )
+    assert request.call_args.kwargs["headers"]["Content-Type"] == (
+        "application/json"
+    )
+    httpx.Timeout.assert_called_once_with(
+        None, connect=30, read=30, write=30, pool=None
+    )
+    session.close()
+    httpx.Client.return_value.close.assert_called_once_with()
+
+
+def test_http2_adapter_send_timeouts() -> None:
+    httpx = mock.MagicMock()
+    httpx.Client.return_value.request.return_value = mock.MagicMock(
+        status_code=503, headers={}, content=b"", reason_phrase="Unavailable"
+    )
+    with mock.patch.object(importlib, "import_module", return_value=httpx):
+        adapter = make_adapter(http2=True)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    r = session.get("https://jmap-example.localhost/", timeout=(5, 60))
+    with pytest.raises(requests.HTTPError):
+        r.raise_for_status()
+    httpx.Timeout.assert_called_once_with(
+        None, connect=5, read=60, write=60, pool=None
+    )
@@ -0,0 +1,29 @@
+from wafflesbot.tuning import SizeTuner
+
+
+def test_size_tuner_grows_fast_requests() -> None:
+    tuner = SizeTuner(target_latency=1.0)
+    assert tuner.adjust("Email/query", 10, 0.1, maximum=500) == 12
+    assert tuner.adjust("Email/query", 1, 0.1, maximum=500) == 2
+    assert tuner.adjust("Email/query", 500, 0.1, maximum=500) == 500
+
+
+def test_size_tuner_shrinks_slow_requests() -> None:
+    tuner = SizeTuner(target_latency=1.0)
+    assert tuner.adjust("Email/changes", 256, 4.0, maximum=500) == 64
+    assert tuner.latency("Email/changes") == 4.0
+    assert tuner.adjust("Email/changes", 1, 4.0, maximum=500) == 1
+
+
+def test_size_tuner_keeps_size_near_target() -> None:
+    tuner = SizeTuner(target_latency=1.0)
+    assert tuner.adjust("Email/query", 10, 0.8, maximum=500) == 10
+
+
+def test_size_tuner_smooths_latency() -> None:
+    tuner = SizeTuner(target_latency=1.0)
+    tuner.adjust("Email/query", 10, 0.1, maximum=500)
+    # A single slow response is not enough to shrink the size
+    assert tuner.adjust("Email/query", 12, 2.0, maximum=500) == 12
+    assert tuner.latency("Email/query") is not None
+    assert tuner.latency("Email/changes") is None
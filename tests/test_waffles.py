@@ -1,31 +1,63 @@
-from typing import Any
+import contextlib
+import dataclasses
+from typing import Any, Optional
 from collections.abc import Iterable
+from pathlib import Path
 from unittest import mock
 
 import pytest
 import sseclient
 from freezegun import freeze_time
-from jmapc.methods import IdentityGet
+from jmapc import Email, SetError, Thread
+from jmapc.client import ClientError
+from jmapc.errors import CannotCalculateChanges
+from jmapc.errors import Error as JMAPError
+from jmapc.errors import UnsupportedFilter
+from jmapc.methods import (
+    EmailGet,
+    EmailGetResponse,
+    EmailQueryResponse,
+    EmailSet,
+    EmailSubmissionSetResponse,
+    InvocationResponse,
+    InvocationResponseOrError,
+    ThreadGetResponse,
+)
+from jmapc.session import SessionPrimaryAccount
 
 from wafflesbot import Waffles
+from wafflesbot.batch import ReplyBatcher
+from wafflesbot.reply import ReplyComposer
+from wafflesbot.state import StateCheckpoint
+from wafflesbot.store import ReplyStore
+from wafflesbot.tuning import SizeTuner
+from wafflesbot.workers import ReplyWorkerPool
 
 from .method_utils import (
-    make_email_archive_call,
+    make_email_archive_method,
     make_email_archive_response,
-    make_email_changes_call,
-    make_email_changes_response,
+    make_email_body_get_call,
+    make_email_body_get_response,
     make_email_event,
+    make_email_event_call,
+    make_email_event_response,
     make_email_get_call,
     make_email_get_response,
+    make_email_get_results,
     make_email_send_call,
     make_email_send_response,
-    make_identity_get_response,
-    make_mailbox_get_call,
-    make_mailbox_get_response,
-    make_thread_get_call,
+    make_email_state_call,
+    make_email_state_response,
+    make_email_updated_call,
+    make_email_updated_response,
+    make_mailbox,
+    make_metadata_changes_response,
+    make_session_capabilities,
     make_thread_get_response,
     make_thread_search_call,
     make_thread_search_response,
+    make_warm_up_call,
+    make_warm_up_response,
 )
 
 
@@ -48,8 +80,9 @@ def wafflesbot() -> Iterable[Waffles]:
 def mock_request(wafflesbot: Waffles) -> Iterable[mock.MagicMock]:
     request_mock = mock.MagicMock()
     session_mock = mock.MagicMock(
-        primary_accounts=dict(mail="u1138"),
+        primary_accounts=SessionPrimaryAccount(mail="u1138"),
         event_source_url="https://jmap-example.localhost/events/",
+        capabilities=make_session_capabilities(),
     )
     with (
         mock.patch("jmapc.client.Client.jmap_session", session_mock),
@@ -108,69 +141,56 @@ def test_wafflesbot(
     wafflesbot.client.live_mode = not dry_run
     mock_events.append(make_email_event(email_state="1118"))
     mock_events.append(make_email_event(email_state="1119"))
-    expected_calls: list[mock._Call] = []
-    expected_calls.append(make_mailbox_get_call("pigeonhole"))
+    expected_calls: list[mock._Call] = [make_warm_up_call()]
     if events:
-        expected_calls.append(make_email_changes_call(since_state="1118"))
-        expected_calls.append(
-            make_email_get_call(properties=["threadId", "mailboxIds"])
-        )
-        expected_calls.append(make_thread_get_call())
-        expected_calls.append(make_email_get_call(fetch_all_body_values=True))
+        expected_calls.append(make_email_state_call())
+        expected_calls.append(make_email_event_call(since_state="1118"))
     else:
         expected_calls.append(make_thread_search_call())
-        expected_calls.append(make_email_get_call(fetch_all_body_values=True))
-    expected_calls.append(mock.call(IdentityGet()))
-    expected_calls.append(make_mailbox_get_call("Drafts"))
-    expected_calls.append(make_mailbox_get_call("Sent"))
-    if not dry_run:
-        expected_calls.append(make_email_send_call())
-    expected_calls.append(make_mailbox_get_call("Inbox"))
+        expected_calls.append(make_email_get_call())
+    expected_calls.append(make_email_body_get_call())
     if not dry_run:
-        archive_call = make_email_archive_call(
-            is_read=original_email_read,
-            is_in_inbox=original_email_in_inbox,
-        )
-        if archive_call:
-            expected_calls.append(archive_call)
-    mock_responses: list[Any] = []
-    mock_responses.append(make_mailbox_get_response("MBX50", "pigeonhole"))
-    if events:
-        mock_responses.append(make_email_changes_response())
-        mock_responses.append(
-            make_email_get_response(
-                is_read=original_email_read,
-                is_in_inbox=original_email_in_inbox,
-                additional_mailbox="MBX50",
+        expected_calls.append(
+            make_email_send_call(
+                archive_method=make_email_archive_method(
+                    is_read=original_email_read,
+                    is_in_inbox=original_email_in_inbox,
+                )
             )
         )
-        mock_responses.append(make_thread_get_response())
+    mock_responses: list[Any] = [make_warm_up_response()]
+    if events:
+        mock_responses.append(make_email_state_response())
         mock_responses.append(
-            make_email_get_response(
-                is_read=original_email_read,
-                is_in_inbox=original_email_in_inbox,
+            make_email_event_response(
+                make_email_get_response(
+                    is_read=original_email_read,
+                    is_in_inbox=original_email_in_inbox,
+                    additional_mailbox="MBX50",
+                ),
+                make_thread_get_response(),
             )
         )
     else:
         mock_responses.append(make_thread_search_response())
         mock_responses.append(
-            make_email_get_response(
-                is_read=original_email_read,
-                is_in_inbox=original_email_in_inbox,
+            make_email_get_results(
+                make_email_get_response(
+                    is_read=original_email_read,
+                    is_in_inbox=original_email_in_inbox,
+                )
             )
         )
-    mock_responses.append(make_identity_get_response())
-    mock_responses.append(make_mailbox_get_response("MBX1002", "Drafts"))
-    mock_responses.append(make_mailbox_get_response("MBX1003", "Sent"))
+    mock_responses.append(make_email_body_get_response())
     if not dry_run:
-        mock_responses.append(make_email_send_response())
-    mock_responses.append(make_mailbox_get_response("MBX1000", "Inbox"))
-    if not dry_run:
-        archive_response = make_email_archive_response(
-            is_read=original_email_read, is_in_inbox=original_email_in_inbox
+        mock_responses.append(
+            make_email_send_response(
+                archive_response=make_email_archive_response(
+                    is_read=original_email_read,
+                    is_in_inbox=original_email_in_inbox,
+                )
+            )
         )
-        if archive_response:
-            mock_responses.append(archive_response)
     mock_request.side_effect = mock_responses
     wafflesbot.run(events=events)
     assert_or_debug_calls(mock_request.call_args_list, expected_calls)
@@ -189,34 +209,24 @@ def test_wafflesbot_no_matching_identity(
     mock_events.append(make_email_event(email_state="1118"))
     mock_events.append(make_email_event(email_state="1119"))
     expected_calls: list[mock._Call] = []
-    expected_calls.append(make_mailbox_get_call("pigeonhole"))
-    expected_calls.append(make_email_changes_call(since_state="1118"))
-    expected_calls.append(
-        make_email_get_call(properties=["threadId", "mailboxIds"])
-    )
-    expected_calls.append(make_thread_get_call())
-    expected_calls.append(make_email_get_call(fetch_all_body_values=True))
-    expected_calls.append(mock.call(IdentityGet()))
+    expected_calls.append(make_warm_up_call())
+    expected_calls.append(make_email_state_call())
+    expected_calls.append(make_email_event_call(since_state="1118"))
     mock_responses: list[Any] = []
-    mock_responses.append(make_mailbox_get_response("MBX50", "pigeonhole"))
-    mock_responses.append(make_email_changes_response())
     mock_responses.append(
-        make_email_get_response(
-            is_read=original_email_read,
-            is_in_inbox=original_email_in_inbox,
-            additional_mailbox="MBX50",
-        )
+        make_warm_up_response(email="unknown.identity@example.com")
     )
-    mock_responses.append(make_thread_get_response())
+    mock_responses.append(make_email_state_response())
     mock_responses.append(
-        make_email_get_response(
-            is_read=original_email_read,
-            is_in_inbox=original_email_in_inbox,
+        make_email_event_response(
+            make_email_get_response(
+                is_read=original_email_read,
+                is_in_inbox=original_email_in_inbox,
+                additional_mailbox="MBX50",
+            ),
+            make_thread_get_response(),
         )
     )
-    mock_responses.append(
-        make_identity_get_response(email="unknown.identity@example.com")
-    )
     mock_request.side_effect = mock_responses
     wafflesbot.run(events=True)
     assert_or_debug_calls(mock_request.call_args_list, expected_calls)
@@ -247,24 +257,22 @@ def test_wafflesbot_ignore_event(
     mock_events.append(make_email_event(email_state="1118"))
     mock_events.append(make_email_event(email_state="1119"))
     expected_calls: list[mock._Call] = []
-    expected_calls.append(make_mailbox_get_call("pigeonhole"))
-    expected_calls.append(make_email_changes_call(since_state="1118"))
-    expected_calls.append(
-        make_email_get_call(properties=["threadId", "mailboxIds"])
-    )
+    expected_calls.append(make_warm_up_call())
+    expected_calls.append(make_email_state_call())
+    expected_calls.append(make_email_event_call(since_state="1118"))
     mock_responses: list[Any] = []
-    mock_responses.append(make_mailbox_get_response("MBX50", "pigeonhole"))
-    mock_responses.append(make_email_changes_response())
+    mock_responses.append(make_warm_up_response())
+    mock_responses.append(make_email_state_response())
     mock_responses.append(
-        make_email_get_response(
-            is_read=original_email_read,
-            is_in_inbox=original_email_in_inbox,
-            additional_mailbox=("MBX50" if in_folder else None),
+        make_email_event_response(
+            make_email_get_response(
+                is_read=original_email_read,
+                is_in_inbox=original_email_in_inbox,
+                additional_mailbox=("MBX50" if in_folder else None),
+            ),
+            make_thread_get_response(has_email_id=not in_folder),
         )
     )
-    if in_folder:
-        expected_calls.append(make_thread_get_call())
-        mock_responses.append(make_thread_get_response(has_email_id=False))
     mock_request.side_effect = mock_responses
     wafflesbot.run(events=True)
     assert_or_debug_calls(mock_request.call_args_list, expected_calls)
@@ -283,11 +291,903 @@ def test_wafflesbot_event_error(
     mock_events.append(make_email_event(email_state="1118"))
     mock_events.append(make_email_event(email_state="1119"))
     expected_calls: list[mock._Call] = []
-    expected_calls.append(make_mailbox_get_call("pigeonhole"))
+    expected_calls.append(make_warm_up_call())
+    expected_calls.append(make_email_state_call())
+    expected_calls.append(make_email_event_call(since_state="1118"))
     mock_responses: list[Any] = []
+    mock_responses.append(make_warm_up_response())
+    mock_responses.append(make_email_state_response())
     mock_responses.append(Exception)
     mock_request.side_effect = mock_responses
     wafflesbot.run(events=True)  # Should not raise an exception
     assert_or_debug_calls(mock_request.call_args_list, expected_calls)
     with pytest.raises(StopIteration):
         mock_request()
+
+
+def test_wafflesbot_event_error_retried(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+    mock_events: list[sseclient.Event],
+    tmp_path: Path,
+) -> None:
+    wafflesbot.client.live_mode = True
+    wafflesbot.client.checkpoint = StateCheckpoint(tmp_path / "state.json")
+    mock_events.append(make_email_event(email_state="1119"))
+    mock_events.append(make_email_event(email_state="1120"))
+    expected_calls: list[mock._Call] = [
+        make_warm_up_call(),
+        make_email_state_call(),
+        make_email_event_call(since_state="1118"),
+        make_email_event_call(since_state="1118"),
+    ]
+    mock_request.side_effect = [
+        make_warm_up_response(),
+        make_email_state_response(),
+        Exception("Temporary failure"),
+        make_email_event_response(
+            make_email_get_response(
+                is_read=True, is_in_inbox=False, additional_mailbox="MBX50"
+            ),
+            make_thread_get_response(has_email_id=False),
+            new_state="1120",
+        ),
+    ]
+    wafflesbot.run(events=True)
+    assert_or_debug_calls(mock_request.call_args_list, expected_calls)
+    assert StateCheckpoint(tmp_path / "state.json").get("u1138") == "1120"
+    with pytest.raises(StopIteration):
+        mock_request()
+
+
+def test_wafflesbot_reply_method_error(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+    mock_events: list[sseclient.Event],
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    wafflesbot.client.live_mode = True
+    mock_events.append(make_email_event(email_state="1118"))
+    mock_events.append(make_email_event(email_state="1119"))
+    archive_response = make_email_archive_response(
+        is_read=False, is_in_inbox=True
+    )
+    assert archive_response
+    archive_response.updated = None
+    archive_response.not_updated = {
+        "Mdeadbeef": SetError(type="notFound", description=None)
+    }
+    mock_request.side_effect = [
+        make_warm_up_response(),
+        make_email_state_response(),
+        make_email_event_response(
+            make_email_get_response(
+                is_read=False, is_in_inbox=True, additional_mailbox="MBX50"
+            ),
+            make_thread_get_response(),
+        ),
+        make_email_body_get_response(),
+        make_email_send_response(archive_response=archive_response),
+    ]
+    wafflesbot.run(events=True)
+    assert "2.Email/set failed for Mdeadbeef" in caplog.text
+    with pytest.raises(StopIteration):
+        mock_request()
+
+
+def test_wafflesbot_reply_send_error(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+    mock_events: list[sseclient.Event],
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    wafflesbot.client.live_mode = True
+    mock_events.append(make_email_event(email_state="1118"))
+    mock_events.append(make_email_event(email_state="1119"))
+    send_response = make_email_send_response(
+        archive_response=make_email_archive_response(
+            is_read=False, is_in_inbox=True
+        )
+    )
+    submission_response = send_response[1].response
+    assert isinstance(submission_response, EmailSubmissionSetResponse)
+    submission_response.created = None
+    submission_response.not_created = {
+        "emailToSend": SetError(type="forbiddenFrom", description=None)
+    }
+    unarchive_method = EmailSet(
+        update={
+            "Mdeadbeef": {
+                "keywords/$seen": None,
+                "keywords/$answered": None,
+                "mailboxIds/MBX1000": True,
+            }
+        }
+    )
+    mock_request.side_effect = [
+        make_warm_up_response(),
+        make_email_state_response(),
+        make_email_event_response(
+            make_email_get_response(
+                is_read=False, is_in_inbox=True, additional_mailbox="MBX50"
+            ),
+            make_thread_get_response(),
+        ),
+        make_email_body_get_response(),
+        send_response,
+        [
+            InvocationResponse(
+                id="0.Email/set",
+                response=make_email_archive_response(
+                    is_read=True, is_in_inbox=False
+                ),
+            )
+        ],
+    ]
+    wafflesbot.run(events=True)
+    assert "1.EmailSubmission/set failed for emailToSend" in caplog.text
+    assert mock_request.call_args_list[-1] == mock.call([unarchive_method])
+    with pytest.raises(StopIteration):
+        mock_request()
+
+
+def test_wafflesbot_batched(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+) -> None:
+    wafflesbot.client.live_mode = True
+    wafflesbot.batcher = ReplyBatcher(wafflesbot._send_replies, max_size=5)
+    archive_method = make_email_archive_method(is_read=False, is_in_inbox=True)
+    expected_calls: list[mock._Call] = [
+        make_warm_up_call(),
+        make_thread_search_call(),
+        make_email_get_call(),
+        make_email_body_get_call(),
+        make_email_send_call(
+            archive_method=archive_method, creation_id_suffix="0"
+        ),
+    ]
+    mock_request.side_effect = [
+        make_warm_up_response(),
+        make_thread_search_response(),
+        make_email_get_results(
+            make_email_get_response(is_read=False, is_in_inbox=True)
+        ),
+        make_email_body_get_response(),
+        make_email_send_response(
+            archive_response=make_email_archive_response(
+                is_read=False, is_in_inbox=True
+            ),
+            creation_id_suffix="0",
+        ),
+    ]
+    wafflesbot.run(events=False)
+    assert_or_debug_calls(mock_request.call_args_list, expected_calls)
+    assert len(wafflesbot.batcher) == 0
+    with pytest.raises(StopIteration):
+        mock_request()
+
+
+def test_wafflesbot_batched_checkpoint(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+    tmp_path: Path,
+) -> None:
+    wafflesbot.client.live_mode = True
+    wafflesbot.client.checkpoint = StateCheckpoint(tmp_path / "state.json")
+    wafflesbot.batcher = ReplyBatcher(wafflesbot._send_replies, max_size=5)
+    mock_responses = iter(
+        [
+            make_warm_up_response(),
+            make_email_state_response(state="2001"),
+            make_thread_search_response(),
+            make_email_get_results(
+                make_email_get_response(is_read=False, is_in_inbox=True)
+            ),
+            make_email_body_get_response(),
+            make_email_send_response(
+                archive_response=make_email_archive_response(
+                    is_read=False, is_in_inbox=True
+                ),
+                creation_id_suffix="0",
+            ),
+        ]
+    )
+    saved_states: list[Optional[str]] = []
+
+    def respond(*args: Any, **kwargs: Any) -> Any:
+        # Record the saved state as of each request
+        checkpoint = StateCheckpoint(tmp_path / "state.json")
+        saved_states.append(checkpoint.get("u1138"))
+        return next(mock_responses)
+
+    mock_request.side_effect = respond
+    wafflesbot.run(events=False)
+    # The state is only saved once the batched reply has been sent
+    assert saved_states == [None] * 6
+    assert StateCheckpoint(tmp_path / "state.json").get("u1138") == "2001"
+
+
+def test_wafflesbot_workers(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+) -> None:
+    wafflesbot.client.live_mode = True
+    wafflesbot.workers = ReplyWorkerPool(wafflesbot._handle_email)
+    expected_calls: list[mock._Call] = [
+        make_warm_up_call(),
+        make_thread_search_call(),
+        make_email_get_call(),
+        make_email_body_get_call(),
+        make_email_send_call(
+            archive_method=make_email_archive_method(
+                is_read=False, is_in_inbox=True
+            )
+        ),
+    ]
+    mock_request.side_effect = [
+        make_warm_up_response(),
+        make_thread_search_response(),
+        make_email_get_results(
+            make_email_get_response(is_read=False, is_in_inbox=True)
+        ),
+        make_email_body_get_response(),
+        make_email_send_response(
+            archive_response=make_email_archive_response(
+                is_read=False, is_in_inbox=True
+            )
+        ),
+    ]
+    wafflesbot.run(events=False)
+    assert_or_debug_calls(mock_request.call_args_list, expected_calls)
+    assert len(wafflesbot.workers) == 0
+
+
+def test_wafflesbot_debounced_events(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+    mock_events: list[sseclient.Event],
+) -> None:
+    wafflesbot.client.debounce_window = 60
+    mock_events.append(make_email_event(email_state="1119"))
+    mock_events.append(make_email_event(email_state="1120"))
+    mock_events.append(make_email_event(email_state="1121"))
+    expected_calls: list[mock._Call] = [
+        make_warm_up_call(),
+        make_email_state_call(),
+        make_email_event_call(since_state="1118"),
+    ]
+    mock_request.side_effect = [
+        make_warm_up_response(),
+        make_email_state_response(),
+        make_email_event_response(
+            make_email_get_response(is_read=True, is_in_inbox=False),
+            make_thread_get_response(has_email_id=False),
+        ),
+    ]
+    wafflesbot.run(events=True)
+    assert_or_debug_calls(mock_request.call_args_list, expected_calls)
+    with pytest.raises(StopIteration):
+        mock_request()
+
+
+def test_wafflesbot_event_paged_changes(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+    mock_events: list[sseclient.Event],
+) -> None:
+    wafflesbot.client.live_mode = True
+    mock_events.append(make_email_event(email_state="1118"))
+    mock_events.append(make_email_event(email_state="1119"))
+    expected_calls: list[mock._Call] = [
+        make_warm_up_call(),
+        make_email_state_call(),
+        make_email_event_call(since_state="1118"),
+        make_email_event_call(since_state="1118.5"),
+        make_email_body_get_call(),
+        make_email_send_call(
+            archive_method=make_email_archive_method(
+                is_read=True, is_in_inbox=False
+            )
+        ),
+    ]
+    mock_request.side_effect = [
+        make_warm_up_response(),
+        make_email_state_response(),
+        make_email_event_response(
+            make_email_get_response(is_read=True, is_in_inbox=False),
+            make_thread_get_response(),
+            new_state="1118.5",
+            has_more_changes=True,
+        ),
+        make_email_event_response(
+            make_email_get_response(
+                is_read=True, is_in_inbox=False, additional_mailbox="MBX50"
+            ),
+            make_thread_get_response(),
+        ),
+        make_email_body_get_response(),
+        make_email_send_response(),
+    ]
+    wafflesbot.run(events=True)
+    assert_or_debug_calls(mock_request.call_args_list, expected_calls)
+    with pytest.raises(StopIteration):
+        mock_request()
+
+
+def test_wafflesbot_script_mode_pages(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+) -> None:
+    wafflesbot.client.live_mode = True
+    wafflesbot.client.threads_page_size = 1
+    expected_calls: list[mock._Call] = [
+        make_warm_up_call(),
+        make_thread_search_call(limit=1),
+        make_thread_search_call(limit=1, anchor="Mdeadbeef"),
+    ]
+    mock_request.side_effect = [
+        make_warm_up_response(),
+        make_thread_search_response(
+            thread_email_ids=["Mdeadbeef", "Mdeadbeef2"]
+        ),
+        make_thread_search_response(ids=[]),
+    ]
+    wafflesbot.run(events=False)
+    assert_or_debug_calls(mock_request.call_args_list, expected_calls)
+    with pytest.raises(StopIteration):
+        mock_request()
+
+
+def _make_thread_page(
+    ids: list[str], position: int = 0
+) -> list[InvocationResponse]:
+    return [
+        InvocationResponse(
+            id="0.Email/query",
+            response=EmailQueryResponse(
+                account_id="u1138",
+                query_state="4000",
+                can_calculate_changes=True,
+                position=position,
+                ids=ids,
+            ),
+        ),
+        InvocationResponse(
+            id="1.Email/get",
+            response=EmailGetResponse(
+                account_id="u1138",
+                state="2187",
+                not_found=[],
+                data=[Email(id=id, thread_id=f"T{id}") for id in ids],
+            ),
+        ),
+        InvocationResponse(
+            id="2.Thread/get",
+            response=ThreadGetResponse(
+                account_id="u1138",
+                state="2187",
+                not_found=[],
+                data=[Thread(id=f"T{id}", email_ids=[id]) for id in ids],
+            ),
+        ),
+    ]
+
+
+def _walk_thread_pages(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+    answered: list[set[str]],
+) -> list[tuple[Optional[str], Optional[int]]]:
+    # Walk pages, answering the given threads from each, and return the
+    # anchor and position of each query
+    pages = wafflesbot.client._recent_thread_pages(
+        make_mailbox("MBX50", "pigeonhole"), after=None
+    )
+    next(pages)
+    for threads in answered:
+        with contextlib.suppress(StopIteration):
+            pages.send(threads)
+    queries = [c.args[0][0] for c in mock_request.call_args_list]
+    return [(q.anchor, q.position) for q in queries]
+
+
+def test_wafflesbot_script_mode_pages_answered(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+) -> None:
+    wafflesbot.client.threads_page_size = 3
+    mock_request.side_effect = [
+        _make_thread_page(["M1", "M2", "M3"]),
+        _make_thread_page(["M4"]),
+    ]
+    # Continue after the last email whose thread was not answered
+    assert _walk_thread_pages(
+        wafflesbot, mock_request, [{"TM1", "TM3"}, set()]
+    ) == [
+        (None, 0),
+        ("M2", None),
+    ]
+
+
+def test_wafflesbot_script_mode_pages_all_answered(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+) -> None:
+    wafflesbot.client.threads_page_size = 2
+    mock_request.side_effect = [
+        _make_thread_page(["M1", "M2"]),
+        _make_thread_page(["M3", "M4"]),
+        _make_thread_page([], position=1),
+    ]
+    # Answered threads leave the results, so the next page starts where the
+    # answered page did
+    assert _walk_thread_pages(
+        wafflesbot, mock_request, [{"TM1", "TM2"}, {"TM4"}, set()]
+    ) == [
+        (None, 0),
+        (None, 0),
+        ("M3", None),
+    ]
+
+
+def test_wafflesbot_script_mode_pages_anchor_not_found(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+) -> None:
+    wafflesbot.client.threads_page_size = 2
+    mock_request.side_effect = [
+        _make_thread_page(["M1", "M2"]),
+        [
+            InvocationResponseOrError(
+                id="0.Email/query",
+                response=JMAPError(type="anchorNotFound"),
+            )
+        ],
+        _make_thread_page([], position=2),
+    ]
+    assert _walk_thread_pages(wafflesbot, mock_request, [set(), set()]) == [
+        (None, 0),
+        ("M2", None),
+        (None, 2),
+    ]
+
+
+def test_wafflesbot_script_mode_tuned_pages(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+) -> None:
+    wafflesbot.client.live_mode = True
+    wafflesbot.client.threads_page_size = 1
+    wafflesbot.client.tuner = SizeTuner(target_latency=1.0)
+    expected_calls: list[mock._Call] = [
+        make_warm_up_call(),
+        make_thread_search_call(limit=1),
+        make_thread_search_call(limit=2, anchor="Mdeadbeef"),
+    ]
+    mock_request.side_effect = [
+        make_warm_up_response(),
+        make_thread_search_response(
+            thread_email_ids=["Mdeadbeef", "Mdeadbeef2"]
+        ),
+        make_thread_search_response(ids=[]),
+    ]
+    wafflesbot.run(events=False)
+    assert_or_debug_calls(mock_request.call_args_list, expected_calls)
+    assert wafflesbot.client.threads_page_size == 3
+
+
+def test_wafflesbot_script_mode_unsupported_filter(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+) -> None:
+    wafflesbot.client.live_mode = True
+    expected_calls: list[mock._Call] = [
+        make_warm_up_call(),
+        make_thread_search_call(),
+        make_thread_search_call(server_side_filters=False),
+    ]
+    mock_request.side_effect = [
+        make_warm_up_response(),
+        [
+            InvocationResponseOrError(
+                id="0.Email/query", response=UnsupportedFilter()
+            )
+        ],
+        make_thread_search_response(ids=[]),
+    ]
+    wafflesbot.run(events=False)
+    assert_or_debug_calls(mock_request.call_args_list, expected_calls)
+    assert not wafflesbot.client.server_side_filters
+    with pytest.raises(StopIteration):
+        mock_request()
+
+
+def test_wafflesbot_resume_from_checkpoint(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+    mock_events: list[sseclient.Event],
+    tmp_path: Path,
+) -> None:
+    wafflesbot.client.live_mode = True
+    mock_events.append(make_email_event(email_state="2001"))
+    checkpoint = StateCheckpoint(tmp_path / "state.json")
+    checkpoint.set("u1138", "1000")
+    wafflesbot.client.checkpoint = checkpoint
+    expected_calls: list[mock._Call] = [
+        make_warm_up_call(),
+        make_email_event_call(since_state="1000"),
+        make_email_body_get_call(),
+        make_email_send_call(
+            archive_method=make_email_archive_method(
+                is_read=True, is_in_inbox=False
+            )
+        ),
+    ]
+    mock_request.side_effect = [
+        make_warm_up_response(),
+        make_email_event_response(
+            make_email_get_response(
+                is_read=True, is_in_inbox=False, additional_mailbox="MBX50"
+            ),
+            make_thread_get_response(),
+        ),
+        make_email_body_get_response(),
+        make_email_send_response(),
+    ]
+    wafflesbot.run(events=True)
+    assert_or_debug_calls(mock_request.call_args_list, expected_calls)
+    with pytest.raises(StopIteration):
+        mock_request()
+
+
+def test_wafflesbot_resume_cannot_calculate_changes(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+    mock_events: list[sseclient.Event],
+    tmp_path: Path,
+) -> None:
+    wafflesbot.client.live_mode = True
+    checkpoint = StateCheckpoint(tmp_path / "state.json")
+    checkpoint.set("u1138", "1000")
+    wafflesbot.client.checkpoint = checkpoint
+    mock_events.append(make_email_event(email_state="1118"))
+    expected_calls: list[mock._Call] = [
+        make_warm_up_call(),
+        make_email_event_call(since_state="1000"),
+        make_email_state_call(),
+    ]
+    mock_request.side_effect = [
+        make_warm_up_response(),
+        ClientError(
+            result=[
+                InvocationResponseOrError(
+                    id="0.Email/changes", response=CannotCalculateChanges()
+                )
+            ]
+        ),
+        make_email_state_response(),
+    ]
+    wafflesbot.run(events=True)
+    assert_or_debug_calls(mock_request.call_args_list, expected_calls)
+    assert StateCheckpoint(tmp_path / "state.json").get("u1138") == "1118"
+    with pytest.raises(StopIteration):
+        mock_request()
+
+
+@pytest.mark.parametrize(
+    "saved_state", [True, False], ids=["saved_state", "no_saved_state"]
+)
+def test_wafflesbot_script_mode_incremental(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+    tmp_path: Path,
+    saved_state: bool,
+) -> None:
+    wafflesbot.client.live_mode = True
+    checkpoint = StateCheckpoint(tmp_path / "state.json")
+    if saved_state:
+        checkpoint.set("u1138", "1000")
+    wafflesbot.client.checkpoint = checkpoint
+    expected_calls: list[mock._Call] = [make_warm_up_call()]
+    mock_responses: list[Any] = [make_warm_up_response()]
+    if saved_state:
+        expected_calls += [
+            make_email_event_call(since_state="1000"),
+        ]
+        mock_responses += [
+            make_email_event_response(
+                make_email_get_response(
+                    is_read=True, is_in_inbox=False, additional_mailbox="MBX50"
+                ),
+                make_thread_get_response(has_email_id=False),
+            ),
+        ]
+    else:
+        expected_calls += [
+            make_email_state_call(),
+            make_thread_search_call(),
+        ]
+        mock_responses += [
+            make_email_state_response(state="2001"),
+            make_thread_search_response(
+                thread_email_ids=["Mdeadbeef", "Mdeadbeef2"]
+            ),
+        ]
+    mock_request.side_effect = mock_responses
+    wafflesbot.run(events=False)
+    assert_or_debug_calls(mock_request.call_args_list, expected_calls)
+    assert StateCheckpoint(tmp_path / "state.json").get("u1138") == "2001"
+    with pytest.raises(StopIteration):
+        mock_request()
+
+
+@pytest.mark.parametrize("events", [True, False], ids=["events", "script"])
+def test_wafflesbot_dry_run_keeps_checkpoint(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+    mock_events: list[sseclient.Event],
+    tmp_path: Path,
+    events: bool,
+) -> None:
+    checkpoint = StateCheckpoint(tmp_path / "state.json")
+    checkpoint.set("u1138", "1000")
+    checkpoint.save()
+    wafflesbot.client.checkpoint = checkpoint
+    mock_events.append(make_email_event(email_state="2001"))
+    mock_request.side_effect = [
+        make_warm_up_response(),
+        make_email_event_response(
+            make_email_get_response(
+                is_read=True, is_in_inbox=False, additional_mailbox="MBX50"
+            ),
+            make_thread_get_response(has_email_id=False),
+        ),
+        make_email_state_response(state="2001"),
+    ]
+    wafflesbot.run(events=events)
+    assert StateCheckpoint(tmp_path / "state.json").get("u1138") == "1000"
+
+
+@pytest.mark.parametrize(
+    "replied", [True, False], ids=["replied", "not_replied"]
+)
+def test_wafflesbot_reply_store(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+    mock_events: list[sseclient.Event],
+    tmp_path: Path,
+    replied: bool,
+) -> None:
+    wafflesbot.client.live_mode = True
+    reply_store = ReplyStore(tmp_path / "replies.db")
+    if replied:
+        reply_store.add("Tbeef1")
+    wafflesbot.client.reply_store = reply_store
+    mock_events.append(make_email_event(email_state="1118"))
+    mock_events.append(make_email_event(email_state="1119"))
+    expected_calls: list[mock._Call] = [
+        make_warm_up_call(),
+        make_email_state_call(),
+        make_email_event_call(since_state="1118"),
+    ]
+    mock_responses: list[Any] = [
+        make_warm_up_response(),
+        make_email_state_response(),
+        make_email_event_response(
+            make_email_get_response(
+                is_read=True, is_in_inbox=False, additional_mailbox="MBX50"
+            ),
+            make_thread_get_response(),
+        ),
+    ]
+    if not replied:
+        expected_calls += [
+            make_email_body_get_call(),
+            make_email_send_call(
+                archive_method=make_email_archive_method(
+                    is_read=True, is_in_inbox=False
+                )
+            ),
+        ]
+        mock_responses += [
+            make_email_body_get_response(),
+            make_email_send_response(
+                archive_response=make_email_archive_response(
+                    is_read=True, is_in_inbox=False
+                )
+            ),
+        ]
+    mock_request.side_effect = mock_responses
+    wafflesbot.run(events=True)
+    assert_or_debug_calls(mock_request.call_args_list, expected_calls)
+    assert reply_store.replied_message_ids(
+        ["first@ness.onett.example.com"]
+    ) == (set() if replied else {"first@ness.onett.example.com"})
+    with pytest.raises(StopIteration):
+        mock_request()
+
+
+def test_wafflesbot_event_mailbox_changes(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+    mock_events: list[sseclient.Event],
+) -> None:
+    renamed = make_mailbox("MBX50", "pigeonhole")
+    mock_events.append(
+        make_email_event(email_state="1119", mailbox_state="2188")
+    )
+    expected_calls: list[mock._Call] = [
+        make_warm_up_call(),
+        make_email_state_call(),
+        make_email_event_call(since_state="1118", metadata_changes=True),
+    ]
+    mock_request.side_effect = [
+        make_warm_up_response(mailboxes={"MBX50": "pigeonhole-old"}),
+        make_email_state_response(),
+        [
+            *make_email_event_response(
+                make_email_get_response(
+                    is_read=True, is_in_inbox=False, additional_mailbox="MBX50"
+                ),
+                make_thread_get_response(has_email_id=False),
+            ),
+            *make_metadata_changes_response([renamed]),
+        ],
+    ]
+    wafflesbot.run(events=True)
+    assert_or_debug_calls(mock_request.call_args_list, expected_calls)
+    assert wafflesbot.client.metadata.mailbox_by_name("pigeonhole") == renamed
+    with pytest.raises(StopIteration):
+        mock_request()
+
+
+def test_wafflesbot_event_updated_thread_cache(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+    mock_events: list[sseclient.Event],
+) -> None:
+    wafflesbot.client.live_mode = True
+    mock_events.append(make_email_event(email_state="1118"))
+    mock_events.append(make_email_event(email_state="1119"))
+    mock_events.append(make_email_event(email_state="1120"))
+    replied_thread = ThreadGetResponse(
+        account_id="u1138",
+        state="2187",
+        not_found=[],
+        data=[Thread(id="Tbeef1", email_ids=["Mdeadbeef", "Mreply"])],
+    )
+    no_emails = EmailGetResponse(
+        account_id="u1138", state="2187", not_found=[], data=[]
+    )
+    expected_calls: list[mock._Call] = [
+        make_warm_up_call(),
+        make_email_state_call(),
+        make_email_event_call(since_state="1118"),
+        make_email_updated_call(["Mdeadbeef"]),
+        make_email_event_call(since_state="2001"),
+    ]
+    mock_request.side_effect = [
+        make_warm_up_response(),
+        make_email_state_response(),
+        make_email_event_response(
+            no_emails,
+            make_thread_get_response(has_email_id=False),
+            created=[],
+            updated=["Mdeadbeef"],
+        ),
+        make_email_updated_response(
+            make_email_get_response(
+                is_read=True, is_in_inbox=False, additional_mailbox="MBX50"
+            ),
+            replied_thread,
+        ),
+        make_email_event_response(
+            no_emails,
+            make_thread_get_response(has_email_id=False),
+            new_state="2002",
+            created=[],
+            updated=["Mdeadbeef", "Mreply"],
+        ),
+    ]
+    wafflesbot.run(events=True)
+    assert_or_debug_calls(mock_request.call_args_list, expected_calls)
+    assert wafflesbot.client.thread_cache.thread_for_email("Mreply") == (
+        "Tbeef1"
+    )
+
+
+@pytest.mark.parametrize(
+    "events", [True, False], ids=["events", "script_mode"]
+)
+def test_wafflesbot_multiple_mailboxes(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+    mock_events: list[sseclient.Event],
+    events: bool,
+) -> None:
+    wafflesbot.client.mailbox_names.append("pigeonhole-eu")
+    wafflesbot.composers["pigeonhole-eu"] = ReplyComposer("<b>Hallo</b>")
+    mock_events.append(make_email_event(email_state="1118"))
+    mock_events.append(make_email_event(email_state="1119"))
+    expected_calls: list[mock._Call] = [make_warm_up_call()]
+    mock_responses: list[Any] = [
+        make_warm_up_response(
+            mailboxes={"MBX50": "pigeonhole", "MBX51": "pigeonhole-eu"}
+        )
+    ]
+    if events:
+        expected_calls.append(make_email_state_call())
+        mock_responses.append(make_email_state_response())
+    email_get_response = make_email_get_response(
+        is_read=False, is_in_inbox=True, additional_mailbox="MBX51"
+    )
+    if events:
+        expected_calls.append(make_email_event_call(since_state="1118"))
+        mock_responses.append(
+            make_email_event_response(
+                email_get_response, make_thread_get_response()
+            )
+        )
+    else:
+        # The same thread is found in both mailboxes, but replied to once
+        expected_calls.append(make_thread_search_call())
+        expected_calls.append(make_email_get_call())
+        mock_responses.append(make_thread_search_response())
+        mock_responses.append(make_email_get_results(email_get_response))
+    expected_calls.append(make_email_body_get_call())
+    mock_responses.append(make_email_body_get_response())
+    if not events:
+        expected_calls.append(make_thread_search_call(mailbox_id="MBX51"))
+        mock_responses.append(make_thread_search_response())
+    mock_request.side_effect = mock_responses
+    with mock.patch.object(
+        ReplyComposer,
+        "compose",
+        autospec=True,
+        side_effect=ReplyComposer.compose,
+    ) as compose_mock:
+        wafflesbot.run(events=events)
+    assert_or_debug_calls(mock_request.call_args_list, expected_calls)
+    compose_mock.assert_called_once_with(
+        wafflesbot.composers["pigeonhole-eu"], email_get_response.data[0]
+    )
+
+
+def test_wafflesbot_chunked_email_get(
+    wafflesbot: Waffles,
+    mock_request: mock.MagicMock,
+) -> None:
+    wafflesbot.client.jmap_session.capabilities = make_session_capabilities(
+        max_objects_in_get=2, max_calls_in_request=2
+    )
+    email = make_email_get_response(is_read=True, is_in_inbox=False).data[0]
+
+    def request(methods: list[EmailGet], raise_errors: bool) -> Any:
+        results = []
+        for i, method in enumerate(methods):
+            assert isinstance(method.ids, list)
+            emails = [
+                dataclasses.replace(email, id=email_id)
+                for email_id in method.ids
+            ]
+            results.append(
+                InvocationResponse(
+                    id=f"{i}.Email/get",
+                    response=EmailGetResponse(
+                        account_id="u1138",
+                        state="2187",
+                        not_found=[],
+                        data=emails,
+                    ),
+                )
+            )
+        return results
+
+    mock_request.side_effect = request
+    ids = ["M1", "M2", "M3", "M4", "M5"]
+    emails = wafflesbot.client._get_emails(ids, wafflesbot.client._email_get)
+    assert [email.id for email in emails] == ids
+    assert sorted(
+        [[method.ids for method in c.args[0]] for c in mock_request.mock_calls]
+    ) == [[["M1", "M2"], ["M3", "M4"]], [["M5"]]]
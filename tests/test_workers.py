@@ -0,0 +1,63 @@
+import threading
+from unittest import mock
+
+from jmapc import Email
+
+from wafflesbot.workers import ReplyWorkerPool
+
+
+def test_workers_handle_emails() -> None:
+    handle = mock.MagicMock()
+    pool = ReplyWorkerPool(handle, workers=2)
+    pool.submit(Email(id="M1"))
+    pool.submit(Email(id="M2"))
+    pool.close()
+    assert sorted(c.args[0].id for c in handle.call_args_list) == [
+        "M1",
+        "M2",
+    ]
+
+
+def test_workers_handle_errors() -> None:
+    handle = mock.MagicMock(side_effect=[Exception("boom"), None])
+    pool = ReplyWorkerPool(handle, workers=1)
+    pool.submit(Email(id="M1"))
+    pool.submit(Email(id="M2"))
+    pool.close()
+    assert handle.call_count == 2
+
+
+def test_workers_backpressure() -> None:
+    released = threading.Event()
+    handled: list[str] = []
+
+    def handle(email: Email) -> None:
+        released.wait(timeout=5)
+        assert email.id
+        handled.append(email.id)
+
+    pool = ReplyWorkerPool(handle, workers=1, max_queued=1)
+    pool.submit(Email(id="M1"))
+    pool.submit(Email(id="M2"))
+    submitted = threading.Event()
+
+    def submit() -> None:
+        pool.submit(Email(id="M3"))
+        submitted.set()
+
+    threading.Thread(target=submit).start()
+    assert not submitted.wait(timeout=0.1)
+    released.set()
+    assert submitted.wait(timeout=5)
+    pool.close()
+    assert handled == ["M1", "M2", "M3"]
+
+
+def test_workers_restart() -> None:
+    handle = mock.MagicMock()
+    pool = ReplyWorkerPool(handle, workers=1)
+    pool.close()
+    pool.start()
+    pool.submit(Email(id="M1"))
+    pool.close()
+    handle.assert_called_once_with(Email(id="M1"))
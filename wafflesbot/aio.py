@@ -0,0 +1,168 @@
+import asyncio
+import contextlib
+import threading
+from collections.abc import AsyncIterator, Callable, Coroutine
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Any, Optional, Union
+
+from jmapc import Email, Event
+
+from .jmap import JMAPClientWrapper
+from .logging import log
+from .waffles import Waffles
+
+
+class AsyncJMAPClientWrapper(JMAPClientWrapper):
+    MAX_CONCURRENCY = 4
+
+    def __init__(
+        self,
+        *args: Any,
+        max_concurrency: int = MAX_CONCURRENCY,
+        **kwargs: Any,
+    ):
+        super().__init__(*args, **kwargs)
+        self.max_concurrency = max_concurrency
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    async def process_events_async(self) -> None:
+        # Handle events in order, but hand emails off to reply tasks so a
+        # slow submission does not hold up the next event
+        async with self._dispatching():
+            all_prev_state = await asyncio.to_thread(self._start_events)
+            try:
+                async for event in self._events_async():
+                    await asyncio.to_thread(
+                        self._handle_event, all_prev_state, event
+                    )
+            finally:
+                await self._drain()
+
+    async def process_recent_emails_without_replies_async(
+        self, since: Optional[timedelta] = None, limit: int = 0
+    ) -> None:
+        async with self._dispatching():
+            try:
+                await asyncio.to_thread(
+                    self.process_recent_emails_without_replies,
+                    since=since,
+                    limit=limit,
+                )
+            finally:
+                await self._drain()
+
+    async def _events_async(self) -> AsyncIterator[Event]:
+        # Read the blocking event stream on a separate thread, and raise its
+        # errors here so they end the run
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue[Union[Event, Exception, None]] = asyncio.Queue()
+
+        def read_events() -> None:
+            try:
+                for event in self._coalesced_events():
+                    loop.call_soon_threadsafe(queue.put_nowait, event)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        threading.Thread(target=read_events, daemon=True).start()
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    @contextlib.asynccontextmanager
+    async def _dispatching(self) -> AsyncIterator[None]:
+        # Run reply callbacks on a bounded pool of threads
+        self._loop = asyncio.get_running_loop()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_concurrency, thread_name_prefix="reply"
+        )
+        try:
+            yield
+        finally:
+            self._executor.shutdown()
+            self._executor = None
+            self._loop = None
+
+    def _reply_to_emails(self, emails: list[Email], limit: int = 0) -> int:
+        if not self._loop:
+            return super()._reply_to_emails(emails, limit=limit)
+        if limit:
+            emails = emails[:limit]
+        if emails:
+            self._loop.call_soon_threadsafe(
+                self._start_task, self._reply_to_batch, emails
+            )
+        return len(emails)
+
+    def _process_emails(self, emails: list[Email], limit: int = 0) -> int:
+        if not self._loop:
+            return super()._process_emails(emails, limit=limit)
+        if limit:
+            emails = emails[:limit]
+        for email in emails:
+            self._loop.call_soon_threadsafe(
+                self._start_task, self._reply, email
+            )
+        return len(emails)
+
+    def _start_task(
+        self, reply: Callable[[Any], Coroutine[Any, Any, None]], arg: Any
+    ) -> None:
+        task = asyncio.get_running_loop().create_task(reply(arg))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _reply_to_batch(self, emails: list[Email]) -> None:
+        # Fetch bodies in one request off the event path, then reply to each
+        # email on its own task
+        try:
+            with_bodies = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._with_bodies, emails
+            )
+        except Exception:
+            log.error(f"Error fetching bodies of {len(emails)} emails")
+            return
+        for email in with_bodies:
+            self._start_task(self._reply, email)
+
+    async def _reply(self, email: Email) -> None:
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, self.new_email_callback, email
+            )
+        except Exception:
+            log.error(f"Error handling email {email}")
+
+    async def _drain(self) -> None:
+        while self._tasks:
+            log.debug(f"Waiting for {len(self._tasks)} replies to finish")
+            await asyncio.gather(*self._tasks)
+
+
+class AsyncWaffles(Waffles):
+    client_class = AsyncJMAPClientWrapper
+    client: AsyncJMAPClientWrapper
+
+    async def run_async(self, limit: int = 0, events: bool = True) -> None:
+        try:
+            if events:
+                await self.client.process_events_async()
+            else:
+                await self.client.process_recent_emails_without_replies_async(
+                    since=self._since(), limit=limit
+                )
+        finally:
+            if self.workers is not None:
+                await asyncio.to_thread(self.workers.close)
+            if self.batcher is not None:
+                await asyncio.to_thread(self.batcher.flush)
+            self.client.save_checkpoint()
@@ -0,0 +1,21 @@
+import time
+
+
+class Backoff:
+    DELAY = 1.0
+    MAX_DELAY = 300.0
+
+    def __init__(self) -> None:
+        self.failures = 0
+        self._started = time.monotonic()
+
+    def start(self) -> None:
+        self._started = time.monotonic()
+
+    def fail(self) -> float:
+        # Wait exponentially longer to restart each time, starting over once
+        # running for as long as the longest wait
+        if time.monotonic() - self._started > self.MAX_DELAY:
+            self.failures = 0
+        self.failures += 1
+        return min(self.DELAY * 2.0 ** (self.failures - 1), self.MAX_DELAY)
@@ -0,0 +1,52 @@
+import threading
+from typing import Callable, Optional
+
+from .jmap import Reply
+from .logging import log
+
+
+class ReplyBatcher:
+    def __init__(
+        self,
+        send: Callable[[list[Reply]], None],
+        max_size: int = 1,
+        window: float = 0.0,
+    ):
+        self.send = send
+        self.max_size = max_size
+        self.window = window
+        self._replies: list[Reply] = []
+        self._lock = threading.RLock()
+        self._timer: Optional[threading.Timer] = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._replies)
+
+    def add(self, reply: Reply) -> None:
+        with self._lock:
+            self._replies.append(reply)
+            if self.max_size and len(self._replies) >= self.max_size:
+                self.flush()
+            elif self.window and not self._timer:
+                # Flush queued replies when the window elapses
+                self._timer = threading.Timer(self.window, self._flush_timer)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            replies, self._replies = self._replies, []
+            if not replies:
+                return
+            log.debug(f"Sending batch of {len(replies)} replies")
+            self.send(replies)
+
+    def _flush_timer(self) -> None:
+        try:
+            self.flush()
+        except Exception as e:
+            log.error(f"Error sending batched replies: {e}")
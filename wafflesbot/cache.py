@@ -0,0 +1,260 @@
+import collections
+import threading
+import time
+from collections.abc import Iterable, Sequence
+from typing import Optional, Union
+
+import jmapc
+from jmapc import Identity, Mailbox, Ref
+from jmapc.errors import Error as JMAPError
+from jmapc.methods import (
+    IdentityChanges,
+    IdentityChangesResponse,
+    IdentityGet,
+    IdentityGetResponse,
+    InvocationResponse,
+    InvocationResponseOrError,
+    MailboxChanges,
+    MailboxChangesResponse,
+    MailboxGet,
+    MailboxGetResponse,
+    Method,
+)
+
+from .logging import log
+
+MethodResponses = Sequence[
+    Union[InvocationResponse, InvocationResponseOrError]
+]
+
+
+class ThreadCache:
+    def __init__(self, max_size: int = 10000) -> None:
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._threads: collections.OrderedDict[str, tuple[str, ...]] = (
+            collections.OrderedDict()
+        )
+        self._email_threads: dict[str, str] = {}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._threads)
+
+    def add(self, thread_id: str, email_ids: Iterable[str]) -> None:
+        with self._lock:
+            self._remove(thread_id)
+            self._threads[thread_id] = tuple(email_ids)
+            for email_id in self._threads[thread_id]:
+                self._email_threads[email_id] = thread_id
+            while len(self._threads) > self.max_size:
+                self._remove(next(iter(self._threads)))
+
+    def thread_for_email(self, email_id: str) -> Optional[str]:
+        with self._lock:
+            thread_id = self._email_threads.get(email_id)
+            if thread_id:
+                self._threads.move_to_end(thread_id)
+            return thread_id
+
+    def discard_email(self, email_id: str) -> None:
+        # Forget the thread decision made when this email was in the thread
+        with self._lock:
+            thread_id = self._email_threads.get(email_id)
+            if thread_id:
+                self._remove(thread_id)
+
+    def _remove(self, thread_id: str) -> None:
+        for email_id in self._threads.pop(thread_id, ()):
+            if self._email_threads.get(email_id) == thread_id:
+                del self._email_threads[email_id]
+
+
+class MetadataCache:
+    TTL = 300.0
+
+    def __init__(self, client: jmapc.Client, ttl: float = TTL) -> None:
+        self.client = client
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._mailboxes: dict[str, Mailbox] = {}
+        self._identities: dict[str, Identity] = {}
+        self._mailbox_state: Optional[str] = None
+        self._identity_state: Optional[str] = None
+        self._stale = False
+        self._checked_at = 0.0
+        self._mailboxes_by_name: dict[str, list[Mailbox]] = {}
+        self._mailboxes_by_role: dict[str, Mailbox] = {}
+        self._identities_by_email: dict[str, Identity] = {}
+
+    def load(self) -> None:
+        with self._lock:
+            self._load()
+
+    def mailboxes_changed(self, state: str) -> None:
+        # Called for pushed Mailbox state changes, to catch up on next use
+        with self._lock:
+            if self._mailbox_state and state != self._mailbox_state:
+                self._stale = True
+
+    def update_methods(self) -> list[Method]:
+        # Calls to catch up on changes when the cache is out of date, for
+        # callers to send along with a request they are making anyway
+        with self._lock:
+            if not self._loaded() or not (self._stale or self._expired()):
+                return []
+            return self._update_methods()
+
+    def apply_update(self, results: MethodResponses) -> None:
+        # Apply the responses to update_methods calls
+        with self._lock:
+            if not self._apply_update(results):
+                # Fetch everything again on next use
+                self._mailbox_state = None
+
+    def mailbox_by_name(self, name: str) -> Optional[Mailbox]:
+        self._refresh()
+        with self._lock:
+            mailboxes = self._mailboxes_by_name.get(name)
+        if not mailboxes:
+            return None
+        assert (
+            len(mailboxes) == 1
+        ), f'Multiple mailboxes found matching "{name}"'
+        return mailboxes[0]
+
+    def mailbox_by_role(self, role: str) -> Optional[Mailbox]:
+        self._refresh()
+        with self._lock:
+            return self._mailboxes_by_role.get(role)
+
+    def identities(self) -> list[Identity]:
+        self._refresh()
+        with self._lock:
+            return list(self._identities.values())
+
+    def identity_by_email(self, email: str) -> Optional[Identity]:
+        self._refresh()
+        with self._lock:
+            return self._identities_by_email.get(email)
+
+    def _refresh(self) -> None:
+        # Callers missing at the same time wait for a single fetch
+        with self._lock:
+            loaded = self._loaded()
+            if loaded and not self._stale and not self._expired():
+                return
+            if not loaded or not self._update():
+                self._load()
+
+    def _loaded(self) -> bool:
+        return bool(self._mailbox_state and self._identity_state)
+
+    def _expired(self) -> bool:
+        return time.monotonic() - self._checked_at >= self.ttl
+
+    def _load(self) -> None:
+        # Fetch all mailboxes and identities in one request
+        results = self.client.request([MailboxGet(ids=None), IdentityGet()])
+        assert len(results) == 2, "Expected 2 method responses in result"
+        mailboxes, identities = results[0].response, results[1].response
+        assert isinstance(
+            mailboxes, MailboxGetResponse
+        ), "Expected MailboxGetResponse in response"
+        assert isinstance(
+            identities, IdentityGetResponse
+        ), "Expected IdentityGetResponse in response"
+        self._mailboxes = {
+            mailbox.id: mailbox for mailbox in mailboxes.data if mailbox.id
+        }
+        self._identities = {
+            identity.id: identity
+            for identity in identities.data
+            if identity.id
+        }
+        self._mailbox_state = mailboxes.state
+        self._identity_state = identities.state
+        self._updated()
+        log.debug(
+            f"Loaded {len(self._mailboxes)} mailboxes and "
+            f"{len(self._identities)} identities"
+        )
+
+    def _update(self) -> bool:
+        # Apply changes since the cached states, or return False if the
+        # server cannot calculate them
+        return self._apply_update(self.client.request(self._update_methods()))
+
+    def _update_methods(self) -> list[Method]:
+        assert self._mailbox_state and self._identity_state
+        return [
+            MailboxChanges(since_state=self._mailbox_state),
+            MailboxGet(ids=Ref("/created")),
+            MailboxGet(ids=Ref("/updated", method=-2)),
+            IdentityChanges(since_state=self._identity_state),
+            IdentityGet(ids=Ref("/created")),
+            IdentityGet(ids=Ref("/updated", method=-2)),
+        ]
+
+    def _apply_update(self, results: MethodResponses) -> bool:
+        responses = [result.response for result in results]
+        if len(responses) != 6 or any(
+            isinstance(response, JMAPError) for response in responses
+        ):
+            log.debug(f"Unable to update mailboxes and identities: {results}")
+            return False
+        (
+            mailbox_changes,
+            mailboxes_created,
+            mailboxes_updated,
+            identity_changes,
+            identities_created,
+            identities_updated,
+        ) = responses
+        assert isinstance(mailbox_changes, MailboxChangesResponse)
+        assert isinstance(mailboxes_created, MailboxGetResponse)
+        assert isinstance(mailboxes_updated, MailboxGetResponse)
+        assert isinstance(identity_changes, IdentityChangesResponse)
+        assert isinstance(identities_created, IdentityGetResponse)
+        assert isinstance(identities_updated, IdentityGetResponse)
+        if (mailbox_changes.old_state, identity_changes.old_state) != (
+            self._mailbox_state,
+            self._identity_state,
+        ):
+            # Another caller has caught up in the meantime
+            return True
+        if mailbox_changes.has_more_changes or (
+            identity_changes.has_more_changes
+        ):
+            # Many changes are quicker to fetch all over again
+            return False
+        for mailbox_id in mailbox_changes.destroyed:
+            self._mailboxes.pop(mailbox_id, None)
+        for mailbox in mailboxes_created.data + mailboxes_updated.data:
+            if mailbox.id:
+                self._mailboxes[mailbox.id] = mailbox
+        for identity_id in identity_changes.destroyed:
+            self._identities.pop(identity_id, None)
+        for identity in identities_created.data + identities_updated.data:
+            if identity.id:
+                self._identities[identity.id] = identity
+        self._mailbox_state = mailbox_changes.new_state
+        self._identity_state = identity_changes.new_state
+        self._updated()
+        return True
+
+    def _updated(self) -> None:
+        self._stale = False
+        self._checked_at = time.monotonic()
+        self._mailboxes_by_name = {}
+        self._mailboxes_by_role = {}
+        for mailbox in self._mailboxes.values():
+            if mailbox.name:
+                self._mailboxes_by_name.setdefault(mailbox.name, []).append(
+                    mailbox
+                )
+            if mailbox.role:
+                self._mailboxes_by_role[mailbox.role] = mailbox
+        self._identities_by_email = {
+            identity.email: identity for identity in self._identities.values()
+        }
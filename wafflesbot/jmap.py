@@ -1,9 +1,15 @@
 import collections
-import functools
+import dataclasses
 import json
+import queue
 import re
+import threading
+import time
+from collections.abc import Generator, Iterator, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Optional, TypeVar, Union
 
 import jmapc
 from jmapc import (
@@ -17,119 +23,331 @@ from jmapc import (
     EmailQueryFilterCondition,
     EmailSubmission,
     Envelope,
+    Event,
     Identity,
     Mailbox,
-    MailboxQueryFilterCondition,
     Ref,
+    Thread,
     TypeState,
 )
+from jmapc.api import APIRequest, APIResponse
+from jmapc.client import REQUEST_TIMEOUT, ClientError
+from jmapc.errors import CannotCalculateChanges
+from jmapc.errors import Error as JMAPError
+from jmapc.errors import UnsupportedFilter
+from jmapc.logging import log as jmapc_log
 from jmapc.methods import (
     EmailChanges,
     EmailChangesResponse,
     EmailGet,
     EmailGetResponse,
     EmailQuery,
+    EmailQueryResponse,
     EmailSet,
+    EmailSetResponse,
     EmailSubmissionSet,
     EmailSubmissionSetResponse,
-    IdentityGet,
-    IdentityGetResponse,
-    MailboxGet,
-    MailboxGetResponse,
-    MailboxQuery,
+    InvocationResponse,
+    InvocationResponseOrError,
     Method,
     ThreadGet,
     ThreadGetResponse,
 )
+from jmapc.session import SessionCapabilitiesCore
 
+from .cache import MetadataCache, ThreadCache
 from .logging import log
+from .state import StateCheckpoint
+from .store import ReplyStore
+from .transport import MAX_CONNECTIONS, make_adapter
+from .tuning import SizeTuner
+
+EMAIL_PROPERTIES = [
+    "id",
+    "threadId",
+    "mailboxIds",
+    "keywords",
+    "from",
+    "to",
+    "replyTo",
+    "subject",
+    "messageId",
+    "references",
+    "receivedAt",
+]
+EMAIL_BODY_PROPERTIES = ["id", "textBody", "htmlBody", "bodyValues"]
+EMAIL_BODY_PART_PROPERTIES = ["partId", "type"]
+
+MethodResponses = Sequence[
+    Union[InvocationResponse, InvocationResponseOrError]
+]
+
+T = TypeVar("T")
+
+
+def _next_page(
+    pages: Generator[T, Optional[set[str]], None], answered: Optional[set[str]]
+) -> Optional[T]:
+    try:
+        return pages.send(answered)
+    except StopIteration:
+        return None
+
+
+def _chunks(items: list[T], size: int) -> Iterator[list[T]]:
+    for start in range(0, len(items), size):
+        end = start + size
+        yield items[start:end]
+
+
+@dataclass
+class Reply:
+    email: Email
+    text_body: str
+    html_body: Optional[str] = None
+    user_agent: Optional[str] = None
 
 
 class JMAPClientWrapper(jmapc.Client):
-    THREADS_GET_LIMIT = 10
+    THREADS_PAGE_SIZE = 10
+    MAX_BODY_VALUE_BYTES = 256 * 1024
 
     def __init__(
         self,
         *args: Any,
-        mailbox_name: str,
+        mailbox_name: Optional[str] = None,
         new_email_callback: Callable[[Email], None],
         drafts_name: str = "Drafts",
         sent_name: str = "Sent",
         inbox_name: str = "Inbox",
         live_mode: bool = False,
+        max_changes: int = 256,
+        threads_page_size: int = THREADS_PAGE_SIZE,
+        checkpoint: Optional[StateCheckpoint] = None,
+        reply_store: Optional[ReplyStore] = None,
+        thread_cache_size: int = 10000,
+        mailbox_names: Sequence[str] = (),
+        server_side_filters: bool = True,
+        max_body_value_bytes: int = MAX_BODY_VALUE_BYTES,
+        debounce_window: float = 0.0,
+        metadata_ttl: float = MetadataCache.TTL,
+        target_latency: Optional[float] = None,
+        max_connections: int = MAX_CONNECTIONS,
+        http2: bool = False,
         **kwargs: Any,
     ):
         super().__init__(*args, **kwargs)
+        self.requests_session.mount(
+            "https://", make_adapter(max_connections, http2=http2)
+        )
+        self.thread_cache = ThreadCache(thread_cache_size)
+        self.checkpoint = checkpoint
+        self.reply_store = reply_store
+        self.max_changes = max_changes
+        self.threads_page_size = threads_page_size
+        self.max_body_value_bytes = max_body_value_bytes
+        self.server_side_filters = server_side_filters
+        self.debounce_window = debounce_window
+        self._stopping = threading.Event()
+        self._session_lock = threading.Lock()
+        self._received: Optional[
+            queue.Queue[Union[Event, Exception, None]]
+        ] = None
+        # Page sizes are tuned to response times if given a target latency
+        self.tuner = SizeTuner(target_latency) if target_latency else None
         self.drafts_name = drafts_name
         self.sent_name = sent_name
         self.inbox_name = inbox_name
         self.live_mode = live_mode
         self.mailbox_name = mailbox_name
+        self.mailbox_names = list(
+            dict.fromkeys(
+                [*([mailbox_name] if mailbox_name else []), *mailbox_names]
+            )
+        )
+        assert self.mailbox_names, "No mailboxes to watch"
         self.new_email_callback = new_email_callback
+        self.metadata = MetadataCache(self, ttl=metadata_ttl)
 
-    def _mailbox_query(
-        self, query_filter: MailboxQueryFilterCondition
-    ) -> Optional[list[Mailbox]]:
-        methods: list[Method] = [
-            MailboxQuery(filter=query_filter),
-            MailboxGet(Ref("/ids")),
-        ]
-        results = self.request(methods)
-        assert (
-            len(results) == 2 and results[1].id == "1.Mailbox/get"
-        ), "Expected 2 method responses in result"
-        assert isinstance(
-            results[1].response, MailboxGetResponse
-        ), "Expected MailboxGetResponse in response"
-        return results[1].response.data
+    def warm_up(self) -> None:
+        # Load all mailboxes and identities in one request, so mailboxes and
+        # identities are not each looked up separately later
+        self.metadata.load()
 
     def process_events(self) -> None:
         # Listen for events from the EventSource endpoint
+        all_prev_state = self._start_events()
+        for event in self._coalesced_events():
+            self._handle_event(all_prev_state, event)
+
+    def save_checkpoint(self) -> None:
+        # Called once queued replies have been sent, so a restart catches up
+        # on emails that were not answered yet. Dry runs leave the saved
+        # state for the next live run to catch up from, as they do not reply
+        # to anything
+        if self.checkpoint and self.live_mode:
+            self.checkpoint.save()
+
+    def _set_checkpoint(self, account_id: str, state: str) -> None:
+        if self.checkpoint and self.live_mode:
+            self.checkpoint.set(account_id, state)
+
+    def stop(self) -> None:
+        # Stop processing events or recent emails from another thread, after
+        # the email currently being handled
+        self._stopping.set()
+        if self._received is not None:
+            self._received.put(None)
+
+    def _coalesced_events(self) -> Iterator[Event]:
+        # Merge events received within the debounce window of the first
+        # into one, so a burst of state changes is handled as one change.
+        # Events are read on another thread so processing can be stopped
+        # while waiting for the next event.
+        received: queue.Queue[Union[Event, Exception, None]] = queue.Queue()
+        self._received = received
+        if self._stopping.is_set():
+            return
+
+        def read_events() -> None:
+            try:
+                for event in self.events:
+                    received.put(event)
+                received.put(None)
+            except Exception as e:
+                received.put(e)
+
+        threading.Thread(target=read_events, daemon=True).start()
+        item: Union[Event, Exception, None] = None
+        while not self._stopping.is_set():
+            item = received.get()
+            if item is None or isinstance(item, Exception):
+                break
+            event, count = item, 1
+            deadline = time.monotonic() + self.debounce_window
+            while (timeout := deadline - time.monotonic()) > 0:
+                try:
+                    item = received.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None or isinstance(item, Exception):
+                    break
+                event, count = self._merge_events(event, item), count + 1
+            if count > 1:
+                log.debug(f"Coalesced {count} events")
+            yield event
+            if item is None or isinstance(item, Exception):
+                break
+        if isinstance(item, Exception):
+            raise item
+
+    @staticmethod
+    def _merge_events(event: Event, next_event: Event) -> Event:
+        # Keep the latest state of each account
+        changed = {**event.data.changed, **next_event.data.changed}
+        return dataclasses.replace(
+            next_event,
+            data=dataclasses.replace(next_event.data, changed=changed),
+        )
+
+    def _start_events(self) -> dict[str, TypeState]:
+        self.warm_up()
         all_prev_state: dict[str, TypeState] = collections.defaultdict(
             TypeState
         )
+        email_state = self._resume_email_state()
+        all_prev_state[self.account_id] = TypeState(email=email_state)
+        self._set_checkpoint(self.account_id, email_state)
         log.info("Listening for events")
-        for event in self.events:
-            log.debug("Received event {event}")
-            for account_id, new_state in event.data.changed.items():
-                prev_state = all_prev_state[account_id]
-                if new_state != prev_state:
-                    if prev_state.email != new_state.email:
-                        try:
-                            self._handle_email_event(
-                                prev_state.email, new_state.email
+        return all_prev_state
+
+    def _handle_event(
+        self, all_prev_state: dict[str, TypeState], event: Event
+    ) -> None:
+        log.debug("Received event {event}")
+        for account_id, new_state in event.data.changed.items():
+            prev_state = all_prev_state[account_id]
+            if account_id == self.account_id and new_state.mailbox:
+                self.metadata.mailboxes_changed(new_state.mailbox)
+            if new_state != prev_state:
+                if prev_state.email != new_state.email:
+                    try:
+                        if prev_state.email:
+                            new_state = dataclasses.replace(
+                                new_state,
+                                email=self._handle_email_event(
+                                    prev_state.email
+                                ),
                             )
-                        except Exception as e:
-                            log.warn(f"Exception in event loop: {e}")
-                    all_prev_state[account_id] = new_state
+                    except Exception as e:
+                        # Keep the previous email state, so the next event
+                        # or run catches up on these changes again
+                        log.warn(f"Exception in event loop: {e}")
+                        new_state = dataclasses.replace(
+                            new_state, email=prev_state.email
+                        )
+                all_prev_state[account_id] = new_state
+                if new_state.email:
+                    self._set_checkpoint(account_id, new_state.email)
 
-    @functools.cache  # noqa: B019
-    def mailbox_by_name(self, name: str) -> Optional[Mailbox]:
-        # Retrieve the Mailbox ID for Drafts
-        mailboxes = self._mailbox_query(MailboxQueryFilterCondition(name=name))
-        if not mailboxes:
+    def _resume_email_state(self) -> str:
+        return self._process_changes_since_saved_state() or (
+            self._get_email_state()
+        )
+
+    def _process_changes_since_saved_state(
+        self, limit: int = 0
+    ) -> Optional[str]:
+        # Catch up on changes since the last saved state, if any
+        saved_state = (
+            self.checkpoint.get(self.account_id) if self.checkpoint else None
+        )
+        if not saved_state:
             return None
-        assert (
-            len(mailboxes) == 1
-        ), f'Multiple mailboxes found matching "{name}"'
-        return mailboxes[0]
+        log.info(f"Resuming from saved email state {saved_state}")
+        try:
+            return self._handle_email_event(saved_state, limit=limit)
+        except ClientError as e:
+            if not any(
+                isinstance(r.response, CannotCalculateChanges)
+                for r in e.result
+            ):
+                raise
+            log.warning(
+                f"Unable to resume from saved email state {saved_state}"
+            )
+        return None
 
-    @functools.cached_property
-    def identities(self) -> list[Identity]:
-        result = self.request(IdentityGet())
-        assert isinstance(result, IdentityGetResponse)
-        return result.data
+    def _get_email_state(self) -> str:
+        result = self.request(EmailGet(ids=[], properties=["id"]))
+        assert isinstance(result, EmailGetResponse)
+        assert result.state
+        return result.state
+
+    def mailbox_by_name(self, name: str) -> Optional[Mailbox]:
+        return self.metadata.mailbox_by_name(name)
+
+    def watched_mailboxes(self) -> list[Mailbox]:
+        mailboxes = []
+        for name in self.mailbox_names:
+            mailbox = self.mailbox_by_name(name)
+            if not mailbox:
+                raise Exception(f'No mailbox named "{name}" found')
+            mailboxes.append(mailbox)
+        return mailboxes
+
+    def mailbox_by_role(self, role: str, name: str) -> Optional[Mailbox]:
+        # Find a special mailbox by its role, or by name if none has the role
+        return self.metadata.mailbox_by_role(role) or self.mailbox_by_name(
+            name
+        )
 
-    @functools.cached_property
-    def identities_by_email(self) -> dict[str, Identity]:
-        return {identity.email: identity for identity in self.identities}
+    @property
+    def identities(self) -> list[Identity]:
+        return self.metadata.identities()
 
-    @functools.cache  # noqa: B019
     def identity_by_email(self, email: str) -> Optional[Identity]:
-        for identity in self.identities:
-            if identity.email == email:
-                return identity
-        return None
+        return self.metadata.identity_by_email(email)
 
     def get_identity_matching_recipients(
         self, email: Email
@@ -137,7 +355,7 @@ class JMAPClientWrapper(jmapc.Client):
         assert email.to
         for recipient in email.to:
             assert recipient.email
-            identity = self.identities_by_email.get(recipient.email)
+            identity = self.identity_by_email(recipient.email)
             if identity:
                 return identity
         return None
@@ -145,13 +363,7 @@ class JMAPClientWrapper(jmapc.Client):
     def archive_email(self, email: Email) -> None:
         if not email.id:
             return
-        inbox = self.mailbox_by_name(self.inbox_name)
-        assert isinstance(inbox, Mailbox)
-        updates: dict[str, Optional[bool]] = {}
-        if not email.keywords or "$seen" not in email.keywords:
-            updates["keywords/$seen"] = True
-        if email.mailbox_ids and inbox.id in email.mailbox_ids:
-            updates[f"mailboxIds/{inbox.id}"] = None
+        updates = self._get_archive_updates(email)
         if not updates:
             return
         method = EmailSet(update={email.id: updates})
@@ -162,6 +374,18 @@ class JMAPClientWrapper(jmapc.Client):
             return
         self.request(method)
 
+    def _get_archive_updates(self, email: Email) -> dict[str, Optional[bool]]:
+        inbox = self.mailbox_by_role("inbox", self.inbox_name)
+        assert isinstance(inbox, Mailbox)
+        updates: dict[str, Optional[bool]] = {}
+        if not email.keywords or "$seen" not in email.keywords:
+            updates["keywords/$seen"] = True
+        if not email.keywords or "$answered" not in email.keywords:
+            updates["keywords/$answered"] = True
+        if email.mailbox_ids and inbox.id in email.mailbox_ids:
+            updates[f"mailboxIds/{inbox.id}"] = None
+        return updates
+
     def send_reply_to_email(
         self,
         email: Email,
@@ -170,6 +394,153 @@ class JMAPClientWrapper(jmapc.Client):
         user_agent: Optional[str] = None,
         keep_sent_copy: bool = True,
     ) -> Optional[EmailSubmission]:
+        reply_email = self._make_reply_email(
+            email, text_body, html_body, user_agent=user_agent
+        )
+        return self.send_email(reply_email, keep_sent_copy=keep_sent_copy)
+
+    def send_reply_and_archive(
+        self,
+        email: Email,
+        text_body: str,
+        html_body: Optional[str] = None,
+        user_agent: Optional[str] = None,
+        keep_sent_copy: bool = True,
+    ) -> Optional[EmailSubmission]:
+        reply = Reply(
+            email=email,
+            text_body=text_body,
+            html_body=html_body,
+            user_agent=user_agent,
+        )
+        sent = self._send_replies_and_archive(
+            {"": reply}, keep_sent_copy=keep_sent_copy
+        )
+        if self.live_mode and "" not in sent:
+            raise Exception(f'Error replying to "{email.subject}"')
+        return sent.get("")
+
+    def send_replies_and_archive(
+        self, replies: Sequence[Reply], keep_sent_copy: bool = True
+    ) -> dict[str, EmailSubmission]:
+        sent = self._send_replies_and_archive(
+            {str(i): reply for i, reply in enumerate(replies)},
+            keep_sent_copy=keep_sent_copy,
+        )
+        for key, reply in enumerate(replies):
+            if self.live_mode and str(key) not in sent:
+                log.error(f'Error replying to "{reply.email.subject}"')
+        # Map creation IDs back to the emails being replied to
+        return {
+            replies[int(key)].email.id or "": submission
+            for key, submission in sent.items()
+        }
+
+    def _send_replies_and_archive(
+        self, replies: dict[str, Reply], keep_sent_copy: bool = True
+    ) -> dict[str, EmailSubmission]:
+        reply_emails = {
+            key: self._make_reply_email(
+                reply.email,
+                reply.text_body,
+                reply.html_body,
+                user_agent=reply.user_agent,
+            )
+            for key, reply in replies.items()
+        }
+        methods = self._make_send_email_methods(
+            reply_emails, keep_sent_copy=keep_sent_copy
+        )
+        # Archive the original emails in the same request as the replies
+        archive_updates: dict[str, dict[str, Any]] = {}
+        for reply in replies.values():
+            updates = self._get_archive_updates(reply.email)
+            if reply.email.id and updates:
+                archive_updates[reply.email.id] = updates
+        if archive_updates:
+            methods.append(EmailSet(update=archive_updates))
+        if not self.live_mode:
+            print("<<<<<<<<<<")
+            for method in methods:
+                print(json.dumps(method.to_dict(), indent=4, sort_keys=True))
+            print(">>>>>>>>>>")
+            return {}
+        results = self.request(methods)
+        self._check_method_responses(results)
+        sent = self._get_sent_data(reply_emails, results)
+        if archive_updates:
+            # Originals are archived even if sending their replies failed
+            not_sent = {
+                reply.email.id
+                for key, reply in replies.items()
+                if key not in sent
+            }
+            self._undo_archive(
+                {
+                    email_id: archive_updates[email_id]
+                    for email_id in self._get_archived_ids(results[-1])
+                    if email_id in not_sent
+                }
+            )
+        if self.reply_store:
+            for key, submission in sent.items():
+                self._record_reply(
+                    replies[key].email, reply_emails[key], submission
+                )
+        return sent
+
+    @staticmethod
+    def _get_archived_ids(
+        result: Union[InvocationResponse, InvocationResponseOrError],
+    ) -> list[str]:
+        response = result.response
+        if not isinstance(response, EmailSetResponse):
+            return []
+        return list(response.updated or {})
+
+    def _undo_archive(self, archived: dict[str, dict[str, Any]]) -> None:
+        # Return originals whose replies were not sent to how they were, so
+        # they are replied to again later
+        if not archived:
+            return
+        log.warning(f"Unarchiving {len(archived)} emails not replied to")
+        results = self.request(
+            [
+                EmailSet(
+                    update={
+                        email_id: {
+                            path: None if value else True
+                            for path, value in updates.items()
+                        }
+                        for email_id, updates in archived.items()
+                    }
+                )
+            ]
+        )
+        self._check_method_responses(results)
+
+    def _record_reply(
+        self, email: Email, reply_email: Email, submission: EmailSubmission
+    ) -> None:
+        assert self.reply_store
+        if not email.thread_id:
+            return
+        self.reply_store.add(
+            thread_id=email.thread_id,
+            message_id=(email.message_id[0] if email.message_id else None),
+            reply_message_id=(
+                reply_email.message_id[0] if reply_email.message_id else None
+            ),
+            submission_id=submission.id,
+        )
+
+    def _make_reply_email(
+        self,
+        email: Email,
+        text_body: str,
+        html_body: Optional[str] = None,
+        user_agent: Optional[str] = None,
+    ) -> Email:
         identity = self.get_identity_matching_recipients(email)
         assert isinstance(
             identity, Identity
@@ -180,7 +551,7 @@ class JMAPClientWrapper(jmapc.Client):
         if user_agent:
             headers.append(EmailHeader(name="User-Agent", value=user_agent))
 
-        reply_email = Email(
+        return Email(
             mail_from=[EmailAddress(email=identity.email)],
             to=[EmailAddress(email=mail_to)],
             subject=f"Re: {email.subject}",
@@ -195,176 +566,633 @@ class JMAPClientWrapper(jmapc.Client):
             headers=headers,
             message_id=[self._make_messageid(identity.email)],
         )
-        return self.send_email(reply_email, keep_sent_copy=keep_sent_copy)
 
     def send_email(
         self, email: Email, keep_sent_copy: bool = True
     ) -> Optional[EmailSubmission]:
-        drafts_mailbox = self.mailbox_by_name(self.drafts_name)
+        methods = self._make_send_email_methods(
+            {"": email}, keep_sent_copy=keep_sent_copy
+        )
+        if not self.live_mode:
+            print("<<<<<<<<<<")
+            for method in methods:
+                print(json.dumps(method.to_dict(), indent=4, sort_keys=True))
+            print(">>>>>>>>>>")
+            return None
+        results = self.request(methods)
+        sent = self._get_sent_data({"": email}, results)
+        assert "" in sent, f"Error sending email: f{results[1].response}"
+        return sent[""]
+
+    def _make_send_email_methods(
+        self, emails: dict[str, Email], keep_sent_copy: bool = True
+    ) -> list[Method]:
+        # Creation IDs for each email are suffixed with its key in emails
+        drafts_mailbox = self.mailbox_by_role("drafts", self.drafts_name)
         assert isinstance(drafts_mailbox, Mailbox)
         assert drafts_mailbox.id
-        if not email.keywords:
-            email.keywords = dict()
-        email.keywords["$draft"] = True
-        if not email.mailbox_ids:
-            email.mailbox_ids = dict()
-        email.mailbox_ids[drafts_mailbox.id] = True
-        assert email.mail_from and email.mail_from[0]
-        identity = self.identity_by_email(email.mail_from[0].email)
-        assert identity
-        assert email.to
-        envelope = Envelope(
-            mail_from=Address(email.mail_from[0].email),
-            rcpt_to=[Address(email=to.email) for to in email.to],
-        )
+        drafts: dict[str, Email] = {}
+        submissions: dict[str, EmailSubmission] = {}
+        for key, email in emails.items():
+            if not email.keywords:
+                email.keywords = dict()
+            email.keywords["$draft"] = True
+            if not email.mailbox_ids:
+                email.mailbox_ids = dict()
+            email.mailbox_ids[drafts_mailbox.id] = True
+            assert email.mail_from and email.mail_from[0].email
+            identity = self.identity_by_email(email.mail_from[0].email)
+            assert identity
+            assert email.to
+            envelope = Envelope(
+                mail_from=Address(email.mail_from[0].email),
+                rcpt_to=[Address(email=to.email) for to in email.to],
+            )
+            drafts[f"draft{key}"] = email
+            submissions[f"emailToSend{key}"] = EmailSubmission(
+                email_id=f"#draft{key}",
+                identity_id=identity.id,
+                envelope=envelope,
+            )
 
         methods: list[Method] = [
-            # Create a draft email in the Drafts mailbox
-            EmailSet(create=dict(draft=email)),
+            # Create draft emails in the Drafts mailbox
+            EmailSet(create=drafts),
         ]
-        email_submission_method = EmailSubmissionSet(
-            create=dict(
-                emailToSend=EmailSubmission(
-                    email_id="#draft",
-                    identity_id=identity.id,
-                    envelope=envelope,
-                )
-            ),
-        )
+        email_submission_method = EmailSubmissionSet(create=submissions)
         if keep_sent_copy:
-            sent_mailbox = self.mailbox_by_name(self.sent_name)
+            sent_mailbox = self.mailbox_by_role("sent", self.sent_name)
             assert isinstance(sent_mailbox, Mailbox)
             # Move from Drafts to Sent on send success
             email_submission_method.on_success_update_email = {
-                "#emailToSend": {
+                f"#{submission_id}": {
                     "keywords/$draft": None,
                     "keywords/$seen": True,
                     f"mailboxIds/{drafts_mailbox.id}": None,
                     f"mailboxIds/{sent_mailbox.id}": True,
                 }
+                for submission_id in submissions
             }
         else:
             # Delete from the Drafts mailbox on send success
-            email_submission_method.on_success_destroy_email = ["#emailToSend"]
+            email_submission_method.on_success_destroy_email = [
+                f"#{submission_id}" for submission_id in submissions
+            ]
         methods.append(email_submission_method)
-        if not self.live_mode:
-            print("<<<<<<<<<<")
-            for method in methods:
-                print(json.dumps(method.to_dict(), indent=4, sort_keys=True))
-            print(">>>>>>>>>>")
-            return None
-        results = self.request(methods)
+        return methods
 
+    def _get_sent_data(
+        self, emails: dict[str, Email], results: MethodResponses
+    ) -> dict[str, EmailSubmission]:
         # Retrieve EmailSubmission/set method response from method responses
         email_send_result = results[1].response
-        assert isinstance(
-            email_send_result, EmailSubmissionSetResponse
-        ), f"Error sending email: f{email_send_result}"
+        if not isinstance(email_send_result, EmailSubmissionSetResponse):
+            return {}
 
         # Retrieve sent email metadata from EmailSubmission/set method response
-        assert email_send_result.created
-        assert email_send_result.created["emailToSend"]
-        sent_data = email_send_result.created["emailToSend"]
-
-        # Print sent email info
-        log.info(
-            'Reply for "{}" sent to {}'.format(
-                email.subject,
-                ", ".join([to.email for to in email.to if to.email]),
+        sent: dict[str, EmailSubmission] = {}
+        for key, email in emails.items():
+            sent_data = (email_send_result.created or {}).get(
+                f"emailToSend{key}"
             )
-        )
-        return sent_data
+            if not sent_data:
+                continue
+            sent[key] = sent_data
+
+            # Print sent email info
+            assert email.to
+            log.info(
+                'Reply for "{}" sent to {}'.format(
+                    email.subject,
+                    ", ".join([to.email for to in email.to if to.email]),
+                )
+            )
+        return sent
+
+    def _check_method_responses(self, results: MethodResponses) -> bool:
+        # Report errors for each method in a request individually
+        success = True
+        for result in results:
+            response = result.response
+            if isinstance(response, JMAPError):
+                log.error(f"{result.id} failed: {response}")
+                success = False
+            elif isinstance(
+                response, (EmailSetResponse, EmailSubmissionSetResponse)
+            ):
+                for errors in (
+                    response.not_created,
+                    response.not_updated,
+                    response.not_destroyed,
+                ):
+                    for object_id, error in (errors or {}).items():
+                        log.error(
+                            f"{result.id} failed for {object_id}: {error}"
+                        )
+                        success = False
+        return success
 
     def process_recent_emails_without_replies(
         self, since: Optional[timedelta] = None, limit: int = 0
     ) -> None:
+        self.warm_up()
+        if self.checkpoint:
+            # Process only changes since the last run, if possible
+            email_state = self._process_changes_since_saved_state(limit=limit)
+            if not email_state:
+                email_state = self._get_email_state()
+                if self._process_recent_emails(since=since, limit=limit):
+                    # Query the same time window again on the next run
+                    return
+            self._set_checkpoint(self.account_id, email_state)
+            return
+        self._process_recent_emails(since=since, limit=limit)
+
+    def _process_recent_emails(
+        self, since: Optional[timedelta] = None, limit: int = 0
+    ) -> bool:
         after: Optional[datetime] = None
         if since:
             after = datetime.now(tz=timezone.utc) - since
-        mailbox = self.mailbox_by_name(self.mailbox_name)
-        if not mailbox:
-            raise Exception(f'No mailbox named "{self.mailbox_name}" found')
-        methods: list[Method] = [
-            EmailQuery(
+        count = 0
+        seen_thread_ids: set[str] = set()
+        for mailbox in self.watched_mailboxes():
+            pages = self._recent_thread_pages(mailbox, after)
+            answered: Optional[set[str]] = None
+            while (
+                thread_get_response := _next_page(pages, answered)
+            ) is not None:
+                # Only process threads found in multiple mailboxes once
+                threads = [
+                    thread
+                    for thread in thread_get_response.data
+                    if thread.id not in seen_thread_ids
+                ]
+                seen_thread_ids.update(thread.id for thread in threads)
+                replied = self._process_email_threads(
+                    dataclasses.replace(thread_get_response, data=threads),
+                    limit=(limit - count if limit else 0),
+                )
+                count += len(replied)
+                if (limit and count >= limit) or self._stopping.is_set():
+                    return True
+                # Replies mark their threads as answered, except in dry runs
+                answered = {
+                    email.thread_id
+                    for email in replied
+                    if email.thread_id and self.live_mode
+                }
+        return False
+
+    def _recent_thread_pages(
+        self, mailbox: Mailbox, after: Optional[datetime]
+    ) -> Generator[ThreadGetResponse, Optional[set[str]], None]:
+        # Walk query results one page at a time, continuing each page after
+        # the last email of the previous page so newly received email does not
+        # shift results between pages. The IDs of threads answered from each
+        # page are sent back, as those threads leave the query results.
+        anchor: Optional[str] = None
+        position = 0
+        while True:
+            limit = self.threads_page_size
+            query = EmailQuery(
                 collapse_threads=True,
-                filter=EmailQueryFilterCondition(
-                    in_mailbox=mailbox.id,
-                    after=after,
-                ),
+                filter=self._recent_emails_filter(mailbox, after),
                 sort=[Comparator(property="receivedAt", is_ascending=False)],
-                limit=self.THREADS_GET_LIMIT,
-            ),
-            EmailGet(ids=Ref("/ids"), properties=["threadId"]),
-            ThreadGet(ids=Ref("/list/*/threadId")),
-        ]
-        results = self.request(methods)
-        assert isinstance(results[2].response, ThreadGetResponse)
-        self._process_email_threads(results[2].response, limit=limit)
+                limit=limit,
+            )
+            if anchor:
+                query.anchor = anchor
+                query.anchor_offset = 1
+            else:
+                query.position = position
+            methods: list[Method] = [
+                query,
+                EmailGet(ids=Ref("/ids"), properties=["threadId"]),
+                ThreadGet(ids=Ref("/list/*/threadId")),
+            ]
+            started = time.monotonic()
+            results = self.request(methods)
+            if self.tuner:
+                self.threads_page_size = self.tuner.adjust(
+                    "Email/query",
+                    limit,
+                    time.monotonic() - started,
+                    maximum=self._limits.max_objects_in_get,
+                )
+            query_response = results[0].response
+            if self.server_side_filters and isinstance(
+                query_response, UnsupportedFilter
+            ):
+                log.info("Server does not support reply filters")
+                self.server_side_filters = False
+                continue
+            if anchor and isinstance(query_response, JMAPError):
+                # Continue by position if the anchor email is no longer found
+                log.debug(f"Email query anchor error: {query_response}")
+                anchor = None
+                continue
+            assert isinstance(query_response, EmailQueryResponse)
+            assert isinstance(results[1].response, EmailGetResponse)
+            assert isinstance(results[2].response, ThreadGetResponse)
+            answered = yield results[2].response
+            ids = query_response.ids
+            assert isinstance(ids, list)
+            if len(ids) < limit:
+                return
+            if not self.server_side_filters:
+                answered = None
+            thread_ids = {
+                email.id: email.thread_id for email in results[1].response.data
+            }
+            # Continue after the last email whose thread is still in the
+            # results, or after the remaining emails if all were answered
+            remaining = [
+                id for id in ids if thread_ids.get(id) not in (answered or ())
+            ]
+            anchor = remaining[-1] if remaining else None
+            position = query_response.position + len(remaining)
 
-    # Create a callback for email state changes
-    def _handle_email_event(
-        self, prev_state: Optional[str], new_state: Optional[str]
-    ) -> None:
-        if not prev_state or not new_state:
-            return
-        mailbox = self.mailbox_by_name(self.mailbox_name)
-        if not mailbox:
-            raise Exception(f'No mailbox named "{self.mailbox_name}" found')
-        email_changes_response = self.request(
-            EmailChanges(since_state=prev_state), raise_errors=True
+    def _recent_emails_filter(
+        self, mailbox: Mailbox, after: Optional[datetime]
+    ) -> EmailQueryFilterCondition:
+        if not self.server_side_filters:
+            return EmailQueryFilterCondition(
+                in_mailbox=mailbox.id, after=after
+            )
+        # Leave out threads with replies (marked as answered), so fewer
+        # threads have to be checked here
+        return EmailQueryFilterCondition(
+            in_mailbox=mailbox.id,
+            after=after,
+            none_in_thread_have_keyword="$answered",
         )
-        assert isinstance(email_changes_response, EmailChangesResponse)
-        email_get_changed_response = self.request(
-            EmailGet(
-                ids=list(
-                    set(
-                        email_changes_response.created
-                        + email_changes_response.updated
+
+    # Create a callback for email state changes
+    def _handle_email_event(self, prev_state: str, limit: int = 0) -> str:
+        mailbox_ids: Optional[set[Optional[str]]] = None
+        state = prev_state
+        count = 0
+        for results in self._email_changes_pages(prev_state):
+            if limit and count >= limit:
+                # Leave the remaining changes for the next run
+                break
+            assert isinstance(results[0].response, EmailChangesResponse)
+            state = results[0].response.new_state
+            if mailbox_ids is None:
+                # Look mailboxes up once the first page has caught up on
+                # mailbox changes
+                mailbox_ids = {
+                    mailbox.id for mailbox in self.watched_mailboxes()
+                }
+            emails: dict[str, Email] = {}
+            threads: dict[str, Thread] = {}
+            for result in results[1:]:
+                if isinstance(result.response, EmailGetResponse):
+                    emails.update(
+                        {
+                            email.id: email
+                            for email in result.response.data
+                            if email.id
+                        }
+                    )
+                else:
+                    assert isinstance(result.response, ThreadGetResponse)
+                    threads.update(
+                        {thread.id: thread for thread in result.response.data}
                     )
-                ),
-                properties=["threadId", "mailboxIds"],
+            for thread in threads.values():
+                if len(thread.email_ids) > 1:
+                    # Threads with replies can never be replied to again
+                    self.thread_cache.add(thread.id, thread.email_ids)
+            eligible = [
+                email
+                for email in emails.values()
+                if email.thread_id in threads
+                and threads[email.thread_id].email_ids == [email.id]
+                and not mailbox_ids.isdisjoint(email.mailbox_ids or {})
+            ]
+            candidates = self._filter_answerable(eligible)
+            processed = self._reply_to_emails(
+                candidates, limit=(limit - count if limit else 0)
+            )
+            count += processed
+            unprocessed = {email.id for email in candidates[processed:]}
+            for email in eligible:
+                if (
+                    email.id
+                    and email.thread_id
+                    and email.id not in unprocessed
+                ):
+                    self.thread_cache.add(email.thread_id, [email.id])
+            if unprocessed:
+                # Revisit this page on the next run
+                state = results[0].response.old_state
+                break
+        return state
+
+    def _email_changes_pages(
+        self, since_state: str
+    ) -> Iterator[MethodResponses]:
+        # Page through email changes until the server has no more changes,
+        # requesting the next page while the current page is processed
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future: Optional[Future[MethodResponses]] = executor.submit(
+                self._email_changes_page, since_state, True
+            )
+            while future:
+                results = future.result()
+                changes = results[0].response
+                assert isinstance(changes, EmailChangesResponse)
+                future = None
+                if changes.has_more_changes:
+                    log.debug(
+                        f"More email changes after state {changes.new_state}"
+                    )
+                    future = executor.submit(
+                        self._email_changes_page, changes.new_state
+                    )
+                yield results
+
+    def _email_changes_page(
+        self, since_state: str, metadata: bool = False
+    ) -> MethodResponses:
+        # Retrieve created emails and their threads in a single request.
+        # Created emails are fetched by reference, so cannot be split to fit
+        # the server limit on objects per get.
+        max_changes = min(self.max_changes, self._limits.max_objects_in_get)
+        # Catch up on mailbox and identity changes in the same request, as
+        # they usually change along with emails
+        metadata_methods = self.metadata.update_methods() if metadata else []
+        started = time.monotonic()
+        results = list(
+            self.request(
+                [
+                    EmailChanges(
+                        since_state=since_state, max_changes=max_changes
+                    ),
+                    self._email_get(Ref("/created")),
+                    ThreadGet(ids=Ref("/list/*/threadId")),
+                    *metadata_methods,
+                ]
             )
         )
-        assert isinstance(email_get_changed_response, EmailGetResponse)
-        thread_ids = [
-            consider_email.thread_id
-            for consider_email in email_get_changed_response.data
-            if consider_email.thread_id
-            and mailbox.id in (consider_email.mailbox_ids or {})
+        if metadata_methods:
+            self.metadata.apply_update(results[3:])
+            results = results[:3]
+        if any(isinstance(result.response, JMAPError) for result in results):
+            raise ClientError(
+                "Errors found in method responses", result=results
+            )
+        if self.tuner:
+            self.max_changes = self.tuner.adjust(
+                "Email/changes",
+                max_changes,
+                time.monotonic() - started,
+                maximum=self._limits.max_objects_in_get,
+            )
+        changes = results[0].response
+        assert isinstance(changes, EmailChangesResponse)
+        for email_id in changes.destroyed:
+            self.thread_cache.discard_email(email_id)
+        # Updated emails (e.g. keyword changes) in threads that were already
+        # decided on cannot change the decision, so only fetch the others
+        updated = [
+            email_id
+            for email_id in changes.updated
+            if not self.thread_cache.thread_for_email(email_id)
         ]
-        if not thread_ids:
-            return
-        thread_get_response = self.request(ThreadGet(ids=thread_ids))
-        assert isinstance(thread_get_response, ThreadGetResponse)
-        self._process_email_threads(thread_get_response)
+        if updated:
+            results.extend(
+                self._chunked_request(
+                    updated,
+                    lambda ids: [
+                        self._email_get(ids),
+                        ThreadGet(ids=Ref("/list/*/threadId")),
+                    ],
+                )
+            )
+        return results
+
+    @property
+    def _limits(self) -> SessionCapabilitiesCore:
+        return self.jmap_session.capabilities.core
+
+    def _api_request(
+        self, request: APIRequest
+    ) -> Sequence[InvocationResponseOrError]:
+        # As in jmapc 0.2.17 to 0.4, but requests are sent from several
+        # threads at once, so the cached session is only dropped once when
+        # its state changes
+        with self._session_lock:
+            session = self.jmap_session
+        raw_request = request.to_json()
+        jmapc_log.debug(f"Sending JMAP request {raw_request}")
+        r = self.requests_session.post(
+            session.api_url,
+            headers={"Content-Type": "application/json"},
+            data=raw_request,
+            timeout=REQUEST_TIMEOUT,
+        )
+        r.raise_for_status()
+        jmapc_log.debug(f"Received JMAP response {r.text}")
+        api_response = APIResponse.from_dict(r.json())
+        with self._session_lock:
+            if (
+                api_response.session_state != session.state
+                and self.__dict__.get("jmap_session") is session
+            ):
+                jmapc_log.debug(
+                    "JMAP response session state"
+                    f' "{api_response.session_state}" differs from cached'
+                    f' state "{session.state}", invalidating cached state'
+                )
+                del self.jmap_session
+        return api_response.method_responses
+
+    def _chunked_request(
+        self,
+        ids: list[str],
+        make_methods: Callable[[list[str]], list[Method]],
+    ) -> list[InvocationResponse]:
+        # Make the methods for chunks of ids within the server limit on
+        # objects per get, and send as many chunks per request as the server
+        # accepts, with requests sent concurrently and results kept in order
+        chunks = [
+            make_methods(chunk)
+            for chunk in _chunks(ids, self._limits.max_objects_in_get)
+        ]
+        if not chunks:
+            return []
+        requests = [
+            [method for chunk in request_chunks for method in chunk]
+            for request_chunks in _chunks(
+                chunks,
+                max(1, self._limits.max_calls_in_request // len(chunks[0])),
+            )
+        ]
+
+        def request(methods: list[Method]) -> Sequence[InvocationResponse]:
+            return self.request(methods, raise_errors=True)
+
+        if len(requests) == 1:
+            return list(request(requests[0]))
+        log.debug(f"Splitting {len(ids)} ids into {len(requests)} requests")
+        with ThreadPoolExecutor(
+            max_workers=min(
+                len(requests), self._limits.max_concurrent_requests
+            )
+        ) as executor:
+            return [
+                result
+                for results in executor.map(request, requests)
+                for result in results
+            ]
+
+    def _get_emails(
+        self, ids: list[str], make_method: Callable[[list[str]], EmailGet]
+    ) -> list[Email]:
+        emails = []
+        for result in self._chunked_request(
+            ids, lambda chunk: [make_method(chunk)]
+        ):
+            assert isinstance(result.response, EmailGetResponse)
+            emails.extend(result.response.data)
+        return emails
+
+    def _email_get(self, ids: Union[Ref, list[str]]) -> EmailGet:
+        # Only fetch what is needed to decide whether to reply to emails
+        return EmailGet(ids=ids, properties=EMAIL_PROPERTIES)
+
+    def _email_body_get(self, ids: list[str]) -> EmailGet:
+        # Fetch text and HTML body values to quote, capped in size
+        return EmailGet(
+            ids=ids,
+            properties=EMAIL_BODY_PROPERTIES,
+            body_properties=EMAIL_BODY_PART_PROPERTIES,
+            fetch_text_body_values=True,
+            fetch_html_body_values=True,
+            max_body_value_bytes=self.max_body_value_bytes,
+        )
 
     def _process_email_threads(
         self,
         thread_get_response: ThreadGetResponse,
         limit: int = 0,
-    ) -> None:
-        email_ids = [
-            thread.email_ids[0]
+    ) -> list[Email]:
+        threads = [
+            thread
             for thread in thread_get_response.data
             if len(thread.email_ids) == 1
         ]
+        if self.reply_store:
+            replied_thread_ids = self.reply_store.replied_thread_ids(
+                thread.id for thread in threads
+            )
+            threads = [
+                thread
+                for thread in threads
+                if thread.id not in replied_thread_ids
+            ]
+        email_ids = [thread.email_ids[0] for thread in threads]
         if not email_ids:
-            return
-        result = self.request(
-            EmailGet(
-                ids=email_ids,
-                fetch_all_body_values=True,
-                max_body_value_bytes=1024**2,
+            return []
+        emails = self._filter_answerable(
+            self._get_emails(email_ids, self._email_get)
+        )
+        if limit:
+            emails = emails[:limit]
+        self._reply_to_emails(emails)
+        return emails
+
+    def _filter_answerable(self, emails: list[Email]) -> list[Email]:
+        # Check emails can be replied to before fetching their bodies
+        return [
+            email
+            for email in self._filter_replied(emails)
+            if self._can_reply(email)
+        ]
+
+    def _can_reply(self, email: Email) -> bool:
+        if not email.message_id:
+            log.info(f'Not replying to "{email.subject}" without message ID')
+            return False
+        if not any(
+            address.email
+            for address in (email.reply_to or []) + (email.mail_from or [])
+        ):
+            log.info(f'Not replying to "{email.subject}" without sender')
+            return False
+        if not email.to or not self.get_identity_matching_recipients(email):
+            log.info(
+                f'Not replying to "{email.subject}" without an identity '
+                "matching any recipients"
+            )
+            return False
+        return True
+
+    def _reply_to_emails(self, emails: list[Email], limit: int = 0) -> int:
+        # Fetch bodies only for the emails that will be replied to
+        if limit:
+            emails = emails[:limit]
+        self._process_emails(self._with_bodies(emails))
+        return len(emails)
+
+    def _with_bodies(self, emails: list[Email]) -> list[Email]:
+        ids = [email.id for email in emails if email.id]
+        if not ids:
+            return []
+        bodies = {
+            body.id: body
+            for body in self._get_emails(ids, self._email_body_get)
+        }
+        with_bodies = []
+        for email in emails:
+            body = bodies.get(email.id)
+            if not body:
+                log.info(f'Email "{email.subject}" no longer exists')
+                continue
+            with_bodies.append(
+                dataclasses.replace(
+                    email,
+                    text_body=body.text_body,
+                    html_body=body.html_body,
+                    body_values=body.body_values,
+                )
             )
+        return with_bodies
+
+    def _filter_replied(self, emails: list[Email]) -> list[Email]:
+        # Skip emails in threads or with message IDs that were replied to
+        if not self.reply_store or not emails:
+            return emails
+        replied_thread_ids = self.reply_store.replied_thread_ids(
+            email.thread_id for email in emails if email.thread_id
         )
-        assert isinstance(result, EmailGetResponse)
-        for i, email in enumerate(result.data):
+        replied_message_ids = self.reply_store.replied_message_ids(
+            message_id
+            for email in emails
+            for message_id in (email.message_id or [])
+        )
+        unreplied = []
+        for email in emails:
+            if email.thread_id in replied_thread_ids or (
+                replied_message_ids & set(email.message_id or [])
+            ):
+                log.debug(f'Already replied to "{email.subject}"')
+                continue
+            unreplied.append(email)
+        return unreplied
+
+    def _process_emails(self, emails: list[Email], limit: int = 0) -> int:
+        for i, email in enumerate(emails):
             if limit and i >= limit:
-                break
+                return i
             try:
                 self.new_email_callback(email)
             except Exception:
                 log.error(f"Error handling email {email}")
+        return len(emails)
 
     def _get_reply_address(self, email: Email) -> str:
         if email.reply_to:
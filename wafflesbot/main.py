@@ -1,11 +1,33 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import os
+import signal
+import sys
+from types import FrameType
+from typing import Any, Optional
 
+from .aio import AsyncJMAPClientWrapper, AsyncWaffles
+from .jmap import JMAPClientWrapper
+from .multi import MultiWaffles, load_accounts
+from .supervisor import Supervisor
+from .transport import MAX_CONNECTIONS
 from .waffles import Waffles
 
 
+def _exit(signum: int, frame: Optional[FrameType]) -> None:
+    sys.exit(128 + signum)
+
+
+def _mailbox_reply(value: str) -> tuple[str, str]:
+    name, sep, path = value.rpartition("=")
+    if not sep or not name:
+        raise argparse.ArgumentTypeError(f'Expected name=file: "{value}"')
+    with open(path) as f:
+        return name, f.read()
+
+
 def main() -> None:
     ap = argparse.ArgumentParser()
     ap.add_argument(
@@ -13,10 +35,19 @@ def main() -> None:
         "--reply-content",
         dest="reply_content",
         metavar="file",
-        required=True,
         type=argparse.FileType("r"),
         help="File with email reply HTML content",
     )
+    ap.add_argument(
+        "-A",
+        "--accounts",
+        dest="accounts",
+        metavar="file",
+        help=(
+            "JSON file listing multiple accounts to serve, instead of "
+            "-m/--mailbox, -r/--reply-content and environment variables"
+        ),
+    )
     ap.add_argument(
         "-d",
         "--debug",
@@ -32,6 +63,19 @@ def main() -> None:
         metavar="name",
         help="Folder or label to examine",
     )
+    ap.add_argument(
+        "-M",
+        "--mailbox-reply",
+        dest="mailbox_replies",
+        metavar="name=file",
+        action="append",
+        default=[],
+        type=_mailbox_reply,
+        help=(
+            "Additional folder or label to examine, with a file with the "
+            "email reply HTML content for it (may be repeated)"
+        ),
+    )
     ap.add_argument(
         "-p",
         "--pretend",
@@ -74,15 +118,212 @@ def main() -> None:
             "valid with -s/--script) (default: %(default)s)"
         ),
     )
+    ap.add_argument(
+        "-b",
+        "--batch-size",
+        dest="batch_size",
+        metavar="count",
+        default=1,
+        type=int,
+        help=(
+            "Maximum number of email replies to send in a single request "
+            "(default: %(default)s)"
+        ),
+    )
+    ap.add_argument(
+        "-w",
+        "--batch-window",
+        dest="batch_window",
+        metavar="seconds",
+        default=0.0,
+        type=float,
+        help=(
+            "Send batched email replies after waiting this many seconds (0 "
+            "to only send full batches) (default: %(default)s)"
+        ),
+    )
+    ap.add_argument(
+        "-D",
+        "--debounce",
+        dest="debounce_window",
+        metavar="seconds",
+        default=0.0,
+        type=float,
+        help=(
+            "Wait this many seconds after an event for more events, and "
+            "handle them together (only valid without -s/--script) "
+            "(default: %(default)s)"
+        ),
+    )
+    ap.add_argument(
+        "-c",
+        "--state-file",
+        dest="state_file",
+        metavar="file",
+        help=(
+            "File to save the last processed email state to, used to catch up "
+            "on missed email at startup and to only process email changes "
+            "since the previous run with -s/--script"
+        ),
+    )
+    ap.add_argument(
+        "-R",
+        "--reply-db",
+        dest="reply_db",
+        metavar="file",
+        help="SQLite database file to record sent email replies in",
+    )
+    ap.add_argument(
+        "-W",
+        "--workers",
+        dest="workers",
+        metavar="count",
+        default=0,
+        type=int,
+        help=(
+            "Number of threads to handle new email on, separately from "
+            "receiving events (0 to handle email as it is received) "
+            "(default: %(default)s)"
+        ),
+    )
+    ap.add_argument(
+        "-q",
+        "--queue-size",
+        dest="max_queued",
+        metavar="count",
+        default=100,
+        type=int,
+        help=(
+            "Maximum number of emails waiting for a worker before receiving "
+            "events is paused (only valid with -W/--workers) "
+            "(default: %(default)s)"
+        ),
+    )
+    ap.add_argument(
+        "-B",
+        "--max-body-size",
+        dest="max_body_value_bytes",
+        metavar="bytes",
+        default=JMAPClientWrapper.MAX_BODY_VALUE_BYTES,
+        type=int,
+        help=(
+            "Maximum size of email text and HTML bodies to fetch and quote "
+            "in replies (default: %(default)s)"
+        ),
+    )
+    ap.add_argument(
+        "-t",
+        "--target-latency",
+        dest="target_latency",
+        metavar="seconds",
+        type=float,
+        help=(
+            "Grow or shrink the number of emails and threads fetched per "
+            "request to keep responses close to this many seconds"
+        ),
+    )
+    ap.add_argument(
+        "-C",
+        "--connections",
+        dest="max_connections",
+        metavar="count",
+        default=MAX_CONNECTIONS,
+        type=int,
+        help=(
+            "Maximum number of HTTP connections to keep open to the JMAP "
+            "server, and of requests to it in flight at once "
+            "(default: %(default)s)"
+        ),
+    )
+    ap.add_argument(
+        "--http2",
+        dest="http2",
+        action="store_true",
+        help="Connect to the JMAP server using HTTP/2 (requires httpx)",
+    )
+    ap.add_argument(
+        "-P",
+        "--processes",
+        dest="processes",
+        metavar="count",
+        default=1,
+        type=int,
+        help=(
+            "Number of worker processes to divide accounts between (only "
+            "valid with -A/--accounts) (default: %(default)s)"
+        ),
+    )
+    ap.add_argument(
+        "-a",
+        "--asyncio",
+        dest="use_asyncio",
+        action="store_true",
+        help="Send email replies concurrently using asyncio",
+    )
+    ap.add_argument(
+        "-j",
+        "--concurrency",
+        dest="max_concurrency",
+        metavar="count",
+        default=AsyncJMAPClientWrapper.MAX_CONCURRENCY,
+        type=int,
+        help=(
+            "Maximum number of email replies to send at once (only valid "
+            "with -a/--asyncio) (default: %(default)s)"
+        ),
+    )
 
     args = ap.parse_args()
-    w = Waffles(
-        debug=args.debug,
+    kwargs: dict[str, Any] = {
+        "debug": args.debug,
+        "live_mode": not args.dry_run,
+        "newer_than_days": args.newer_than_days,
+        "batch_size": args.batch_size,
+        "batch_window": args.batch_window,
+        "workers": args.workers,
+        "max_queued": args.max_queued,
+        "max_body_value_bytes": args.max_body_value_bytes,
+        "debounce_window": args.debounce_window,
+        "target_latency": args.target_latency,
+        "max_connections": args.max_connections,
+        "http2": args.http2,
+    }
+    # Exit cleanly on SIGTERM so queued emails are handled before exiting
+    signal.signal(signal.SIGTERM, _exit)
+    if args.accounts:
+        if args.use_asyncio:
+            ap.error("-a/--asyncio is not supported with -A/--accounts")
+        accounts = load_accounts(args.accounts)
+        if args.processes > 1:
+            Supervisor(accounts, processes=args.processes, **kwargs).run(
+                limit=args.limit, events=args.events
+            )
+        else:
+            MultiWaffles(accounts, **kwargs).run(
+                limit=args.limit, events=args.events
+            )
+        return
+    if args.mailbox and not args.reply_content:
+        ap.error("-r/--reply-content is required with -m/--mailbox")
+    if not args.mailbox and not args.mailbox_replies:
+        ap.error("-m/--mailbox or -M/--mailbox-reply is required")
+    waffles_class = Waffles
+    if args.use_asyncio:
+        waffles_class = AsyncWaffles
+        kwargs["max_concurrency"] = args.max_concurrency
+    w = waffles_class(
         host=os.environ["JMAP_HOST"],
         api_token=os.environ["JMAP_API_TOKEN"],
-        live_mode=not args.dry_run,
-        reply_content=args.reply_content.read(),
-        newer_than_days=args.newer_than_days,
+        reply_content=(
+            args.reply_content.read() if args.reply_content else ""
+        ),
         mailbox_name=args.mailbox,
+        mailboxes=dict(args.mailbox_replies),
+        state_file=args.state_file,
+        reply_db=args.reply_db,
+        **kwargs,
     )
-    w.run(limit=args.limit, events=args.events)
+    if isinstance(w, AsyncWaffles):
+        asyncio.run(w.run_async(limit=args.limit, events=args.events))
+    else:
+        w.run(limit=args.limit, events=args.events)
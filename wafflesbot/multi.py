@@ -0,0 +1,136 @@
+import collections
+import json
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Optional, Union
+
+from .backoff import Backoff
+from .logging import log
+from .transport import MAX_CONNECTIONS, make_adapter
+from .waffles import Waffles
+
+
+@dataclass
+class AccountConfig:
+    host: str
+    api_token: str
+    mailbox: Optional[str] = None
+    reply_content: str = ""
+    mailboxes: dict[str, str] = field(default_factory=dict)
+    name: Optional[str] = None
+    state_file: Optional[str] = None
+    reply_db: Optional[str] = None
+
+    @property
+    def label(self) -> str:
+        mailbox = self.mailbox or ",".join(self.mailboxes)
+        return self.name or f"{self.host}/{mailbox}"
+
+
+def load_accounts(path: Union[str, Path]) -> list[AccountConfig]:
+    # Load a JSON list of accounts, reading API tokens and reply content
+    # from files where given as "api_token_file" and "reply_content_file",
+    # and reply content for more mailboxes from "mailbox_reply_files"
+    with open(path) as f:
+        data = json.load(f)
+    assert isinstance(data, list), f"Expected a list of accounts in {path}"
+    accounts = []
+    for entry in data:
+        entry = dict(entry)
+        if "api_token_file" in entry:
+            entry["api_token"] = (
+                Path(entry.pop("api_token_file")).read_text().strip()
+            )
+        if "reply_content_file" in entry:
+            entry["reply_content"] = Path(
+                entry.pop("reply_content_file")
+            ).read_text()
+        for name, reply_file in entry.pop("mailbox_reply_files", {}).items():
+            entry.setdefault("mailboxes", {})[name] = Path(
+                reply_file
+            ).read_text()
+        accounts.append(AccountConfig(**entry))
+    labels = [account.label for account in accounts]
+    assert len(set(labels)) == len(labels), f"Duplicate accounts in {path}"
+    return accounts
+
+
+class MultiWaffles:
+    def __init__(self, accounts: list[AccountConfig], **kwargs: Any):
+        self._stopping = threading.Event()
+        # Accounts on the same host share one HTTP connection pool, while
+        # each account keeps its own client, caches and saved state
+        accounts_by_host = collections.Counter(
+            account.host for account in accounts
+        )
+        max_connections = kwargs.get("max_connections", MAX_CONNECTIONS)
+        self.adapters = {
+            host: make_adapter(
+                count * max_connections, http2=kwargs.get("http2", False)
+            )
+            for host, count in accounts_by_host.items()
+        }
+        self.bots: dict[str, Waffles] = {}
+        for account in accounts:
+            bot = Waffles(
+                host=account.host,
+                api_token=account.api_token,
+                mailbox_name=account.mailbox,
+                mailboxes=account.mailboxes,
+                reply_content=account.reply_content,
+                state_file=account.state_file,
+                reply_db=account.reply_db,
+                **kwargs,
+            )
+            bot.client.requests_session.mount(
+                f"https://{account.host}/", self.adapters[account.host]
+            )
+            self.bots[account.label] = bot
+
+    def run(self, limit: int = 0, events: bool = True) -> None:
+        threads = [
+            threading.Thread(
+                target=self._run_bot,
+                args=(label, bot, limit, events),
+                name=label,
+            )
+            for label, bot in self.bots.items()
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        finally:
+            # Let each account finish the email it is handling and save its
+            # state, such as when exiting on SIGTERM
+            self.stop()
+            for thread in threads:
+                thread.join()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        for bot in self.bots.values():
+            bot.client.stop()
+
+    def _run_bot(
+        self, label: str, bot: Waffles, limit: int, events: bool
+    ) -> None:
+        backoff = Backoff()
+        while not self._stopping.is_set():
+            log.info(f'Starting account "{label}"')
+            backoff.start()
+            try:
+                bot.run(limit=limit, events=events)
+                return
+            except Exception as e:
+                if not events:
+                    log.error(f'Account "{label}" stopped: {e}')
+                    return
+                delay = backoff.fail()
+                log.error(
+                    f'Account "{label}" stopped: {e}, restarting in '
+                    f"{delay:.0f}s after {backoff.failures} failures"
+                )
+                self._stopping.wait(delay)
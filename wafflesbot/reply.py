@@ -1,3 +1,4 @@
+import threading
 from typing import Optional
 
 from jmapc import Email
@@ -6,6 +7,7 @@ from replyowl import ReplyOwl
 from replyowl import version as replyowl_version
 
 from . import version
+from .template import ReplyTemplate
 
 
 def _get_email_body_text(email: Email) -> Optional[str]:
@@ -14,7 +16,10 @@ def _get_email_body_text(email: Email) -> Optional[str]:
     text_data = email.text_body[0]
     if not text_data or not text_data.part_id:
         return None
-    return email.body_values[text_data.part_id].value
+    body_value = email.body_values[text_data.part_id]
+    if body_value.is_truncated and body_value.value:
+        return f"{body_value.value}\n[...]"
+    return body_value.value
 
 
 def _get_email_body_html(email: Email) -> Optional[str]:
@@ -23,32 +28,74 @@ def _get_email_body_html(email: Email) -> Optional[str]:
     html_data = email.html_body[0]
     if not html_data or not html_data.part_id:
         return None
-    return email.body_values[html_data.part_id].value
+    body_value = email.body_values[html_data.part_id]
+    if body_value.is_truncated:
+        # Quote the text body instead of partial HTML
+        return None
+    return body_value.value
 
 
-def compose_reply(
-    email: Email, reply_content: str
-) -> tuple[str, Optional[str], Optional[str]]:
-    replyowl = ReplyOwl()
-    text_body, html_body = replyowl.compose_reply(
-        content=reply_content,
-        quote_html=_get_email_body_html(email),
-        quote_text=_get_email_body_text(email),
-        quote_attribution=_quote_attribution_line(email),
-    )
-    assert text_body
-    user_agent = (
-        f"wafflesbot/{version} ("
-        + ", ".join(
-            (
-                f"jmapc {jmapc_version}",
-                f"replyowl {replyowl_version}",
+class _ContentReplyOwl(ReplyOwl):
+    # Use text content converted ahead of time rather than converting the
+    # reply content for every reply
+    def __init__(self) -> None:
+        super().__init__()
+        self._content: Optional[tuple[str, str]] = None
+
+    def set_content_text(self, content: str, content_text: str) -> None:
+        self._content = (content, content_text)
+
+    def html_to_text(self, html: str) -> str:
+        if self._content and html == self._content[0]:
+            return self._content[1]
+        return super().html_to_text(html)
+
+
+class ReplyComposer:
+    def __init__(self, reply_content: str) -> None:
+        self.reply_content = reply_content
+        # ReplyOwl's HTML parser is stateful, so each thread composing
+        # replies gets its own
+        self._local = threading.local()
+        self.template = ReplyTemplate(reply_content)
+        self.text_template = self.template.convert(self.replyowl.html_to_text)
+        self.user_agent = (
+            f"wafflesbot/{version} ("
+            + ", ".join(
+                (
+                    f"jmapc {jmapc_version}",
+                    f"replyowl {replyowl_version}",
+                )
             )
+            + ")"
         )
-        + ")"
-    )
 
-    return text_body, html_body, user_agent
+    def compose(self, email: Email) -> tuple[str, Optional[str], str]:
+        content = self.template.render(email)
+        self.replyowl.set_content_text(
+            content, self.text_template.render(email)
+        )
+        text_body, html_body = self.replyowl.compose_reply(
+            content=content,
+            quote_html=_get_email_body_html(email),
+            quote_text=_get_email_body_text(email),
+            quote_attribution=_quote_attribution_line(email),
+        )
+        assert text_body
+        return text_body, html_body, self.user_agent
+
+    @property
+    def replyowl(self) -> _ContentReplyOwl:
+        replyowl = getattr(self._local, "replyowl", None)
+        if replyowl is None:
+            replyowl = self._local.replyowl = _ContentReplyOwl()
+        return replyowl
+
+
+def compose_reply(
+    email: Email, reply_content: str
+) -> tuple[str, Optional[str], Optional[str]]:
+    return ReplyComposer(reply_content).compose(email)
 
 
 def _quote_attribution_line(email: Email) -> str:
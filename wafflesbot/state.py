@@ -0,0 +1,70 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+from .logging import log
+
+
+class StateCheckpoint:
+    def __init__(
+        self, path: Union[str, Path], save_interval: float = 10.0
+    ) -> None:
+        self.path = Path(path)
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._states: dict[str, str] = self._load()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def get(self, account_id: str) -> Optional[str]:
+        with self._lock:
+            return self._states.get(account_id)
+
+    def set(self, account_id: str, state: str) -> None:
+        with self._lock:
+            if self._states.get(account_id) == state:
+                return
+            self._states[account_id] = state
+            self._dirty = True
+            due = time.monotonic() - self._saved_at >= self.save_interval
+        # Batch state updates into periodic writes
+        if due:
+            self.save()
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self._states, indent=4, sort_keys=True)
+            # Write to a temporary file and rename it over the checkpoint so
+            # the checkpoint is never partially written
+            fd, temp_path = tempfile.mkstemp(
+                dir=self.path.parent, prefix=f".{self.path.name}."
+            )
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+            self._dirty = False
+            self._saved_at = time.monotonic()
+            log.debug(f"Saved email state checkpoint to {self.path}")
+
+    def _load(self) -> dict[str, str]:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            log.warning(f"Ignoring invalid state checkpoint {self.path}: {e}")
+            return {}
+        return {str(k): str(v) for k, v in data.items()}
@@ -0,0 +1,115 @@
+import sqlite3
+import threading
+import time
+from collections.abc import Iterable
+from datetime import timedelta
+from pathlib import Path
+from typing import Optional, Union
+
+from .logging import log
+
+# Stay below SQLite's default limit on the number of query parameters
+QUERY_CHUNK_SIZE = 500
+DEFAULT_RETENTION = timedelta(days=365)
+
+
+class ReplyStore:
+    def __init__(
+        self,
+        path: Union[str, Path],
+        retention: Optional[timedelta] = DEFAULT_RETENTION,
+        compact_interval: int = 1000,
+    ) -> None:
+        self.path = path
+        self.retention = retention
+        self.compact_interval = compact_interval
+        self._lock = threading.Lock()
+        self._added = 0
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS replies ("
+                "thread_id TEXT NOT NULL, "
+                "message_id TEXT, "
+                "reply_message_id TEXT, "
+                "submission_id TEXT, "
+                "replied_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS replies_thread_id "
+                "ON replies (thread_id)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS replies_message_id "
+                "ON replies (message_id)"
+            )
+        self.compact()
+
+    def add(
+        self,
+        thread_id: str,
+        message_id: Optional[str] = None,
+        reply_message_id: Optional[str] = None,
+        submission_id: Optional[str] = None,
+    ) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO replies (thread_id, message_id, "
+                "reply_message_id, submission_id, replied_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    thread_id,
+                    message_id,
+                    reply_message_id,
+                    submission_id,
+                    time.time(),
+                ),
+            )
+            self._added += 1
+            compact = self._added % self.compact_interval == 0
+        if compact:
+            self.compact()
+
+    def replied_thread_ids(self, thread_ids: Iterable[str]) -> set[str]:
+        return self._find("thread_id", thread_ids)
+
+    def replied_message_ids(self, message_ids: Iterable[str]) -> set[str]:
+        return self._find("message_id", message_ids)
+
+    def compact(self) -> None:
+        if not self.retention:
+            return
+        expire_before = time.time() - self.retention.total_seconds()
+        with self._lock:
+            with self._db:
+                deleted = self._db.execute(
+                    "DELETE FROM replies WHERE replied_at < ?",
+                    (expire_before,),
+                ).rowcount
+            if deleted:
+                log.debug(
+                    f"Removed {deleted} expired replies from {self.path}"
+                )
+                self._db.execute("VACUUM")
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def _find(self, column: str, values: Iterable[str]) -> set[str]:
+        values = list(set(values))
+        found: set[str] = set()
+        with self._lock:
+            for start in range(0, len(values), QUERY_CHUNK_SIZE):
+                end = start + QUERY_CHUNK_SIZE
+                chunk = values[start:end]
+                placeholders = ", ".join("?" * len(chunk))
+                found.update(
+                    row[0]
+                    for row in self._db.execute(
+                        f"SELECT DISTINCT {column} FROM replies "  # nosec B608
+                        f"WHERE {column} IN ({placeholders})",
+                        chunk,
+                    )
+                )
+        return found
@@ -0,0 +1,148 @@
+import bisect
+import hashlib
+import multiprocessing
+import signal
+import time
+from collections.abc import Iterable
+from types import FrameType
+from typing import Any, Optional
+
+from .backoff import Backoff
+from .logging import log
+from .multi import AccountConfig, MultiWaffles
+
+Worker = tuple[list[str], multiprocessing.Process]
+
+
+class HashRing:
+    def __init__(self, nodes: Iterable[int], replicas: int = 100) -> None:
+        self._ring = sorted(
+            (self._hash(f"{node}:{i}"), node)
+            for node in nodes
+            for i in range(replicas)
+        )
+        self._hashes = [h for h, _ in self._ring]
+
+    def node_for(self, key: str) -> int:
+        i = bisect.bisect(self._hashes, self._hash(key)) % len(self._ring)
+        return self._ring[i][1]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+
+
+def _run_shard(
+    accounts: list[AccountConfig],
+    kwargs: dict[str, Any],
+    limit: int,
+    events: bool,
+) -> None:
+    # Worker count changes are handled by the supervisor only
+    signal.signal(signal.SIGTTIN, signal.SIG_IGN)
+    signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+    MultiWaffles(accounts, **kwargs).run(limit=limit, events=events)
+
+
+class Supervisor:
+    POLL_INTERVAL = 1.0
+    STOP_TIMEOUT = 30.0
+
+    def __init__(
+        self, accounts: list[AccountConfig], processes: int = 1, **kwargs: Any
+    ):
+        self.accounts = {account.label: account for account in accounts}
+        self.processes = processes
+        self.kwargs = kwargs
+        # Worker processes and their account labels, by worker index
+        self._workers: dict[int, Worker] = {}
+        self._finished: set[int] = set()
+        # Backoffs and restart times, by worker index, to back off from
+        # restarting workers that keep exiting
+        self._backoffs: dict[int, Backoff] = {}
+        self._restart_at: dict[int, float] = {}
+
+    def shards(self) -> dict[int, list[str]]:
+        # Assign accounts to workers so that changing the number of workers
+        # only moves the accounts of added or removed workers
+        ring = HashRing(range(self.processes))
+        shards: dict[int, list[str]] = {}
+        for label in sorted(self.accounts):
+            shards.setdefault(ring.node_for(label), []).append(label)
+        return shards
+
+    def run(self, limit: int = 0, events: bool = True) -> None:
+        signal.signal(signal.SIGTTIN, self._add_process)
+        signal.signal(signal.SIGTTOU, self._remove_process)
+        try:
+            while self._reconcile(limit=limit, events=events):
+                time.sleep(self.POLL_INTERVAL)
+        finally:
+            for index in list(self._workers):
+                self._stop(index)
+
+    def _reconcile(self, limit: int, events: bool) -> bool:
+        shards = self.shards()
+        for index, (labels, process) in list(self._workers.items()):
+            if shards.get(index) != labels:
+                log.info(f"Rebalancing accounts of worker {index}")
+                self._stop(index)
+            elif not process.is_alive():
+                del self._workers[index]
+                if process.exitcode or events:
+                    self._back_off(index, process.exitcode)
+                else:
+                    self._finished.add(index)
+        now = time.monotonic()
+        for index, labels in shards.items():
+            if (
+                index not in self._workers
+                and index not in self._finished
+                and self._restart_at.get(index, 0.0) <= now
+            ):
+                self._start(index, labels, limit=limit, events=events)
+                self._backoffs.setdefault(index, Backoff()).start()
+        return bool(self._workers)
+
+    def _start(
+        self, index: int, labels: list[str], limit: int, events: bool
+    ) -> None:
+        log.info(f"Starting worker {index} for {len(labels)} accounts")
+        process = multiprocessing.Process(
+            target=_run_shard,
+            args=(
+                [self.accounts[label] for label in labels],
+                self.kwargs,
+                limit,
+                events,
+            ),
+            name=f"worker-{index}",
+        )
+        process.start()
+        self._workers[index] = (labels, process)
+
+    def _back_off(self, index: int, exitcode: Optional[int]) -> None:
+        backoff = self._backoffs.setdefault(index, Backoff())
+        delay = backoff.fail()
+        self._restart_at[index] = time.monotonic() + delay
+        log.warning(
+            f"Worker {index} exited with code {exitcode}, restarting in "
+            f"{delay:.0f}s after {backoff.failures} failures"
+        )
+
+    def _stop(self, index: int) -> None:
+        _, process = self._workers.pop(index)
+        process.terminate()
+        process.join(self.STOP_TIMEOUT)
+        if process.is_alive():
+            log.warning(f"Worker {index} did not stop, killing")
+            process.kill()
+            process.join()
+
+    def _add_process(self, signum: int, frame: Optional[FrameType]) -> None:
+        self.processes += 1
+        log.info(f"Increasing to {self.processes} workers")
+
+    def _remove_process(self, signum: int, frame: Optional[FrameType]) -> None:
+        self.processes = max(1, self.processes - 1)
+        log.info(f"Decreasing to {self.processes} workers")
@@ -0,0 +1,69 @@
+import html
+import re
+from typing import Callable
+
+from jmapc import Email
+
+PLACEHOLDER_RE = re.compile(r"{{\s*(\w+)\s*}}")
+
+
+def _sender_name(email: Email) -> str:
+    if not email.mail_from:
+        return ""
+    return email.mail_from[0].name or email.mail_from[0].email or ""
+
+
+def _sender_email(email: Email) -> str:
+    if not email.mail_from:
+        return ""
+    return email.mail_from[0].email or ""
+
+
+def _received_date(email: Email) -> str:
+    if not email.received_at:
+        return ""
+    return email.received_at.astimezone().strftime("%a %b %-d %Y")
+
+
+FIELDS: dict[str, Callable[[Email], str]] = {
+    "sender_name": _sender_name,
+    "sender_email": _sender_email,
+    "subject": lambda email: email.subject or "",
+    "received_date": _received_date,
+}
+
+
+class ReplyTemplate:
+    def __init__(self, source: str, escape: bool = True) -> None:
+        self.source = source
+        self.escape = escape
+        # Split into alternating literal text and placeholder names
+        parts = PLACEHOLDER_RE.split(source)
+        self._literals = parts[::2]
+        self._names = parts[1::2]
+        for name in self._names:
+            if name not in FIELDS:
+                raise Exception(f'Unknown reply template placeholder "{name}"')
+        self._fields = [FIELDS[name] for name in self._names]
+
+    def render(self, email: Email) -> str:
+        if not self._fields:
+            return self.source
+        rendered = [self._literals[0]]
+        for field, literal in zip(self._fields, self._literals[1:]):
+            value = field(email)
+            rendered.append(html.escape(value) if self.escape else value)
+            rendered.append(literal)
+        return "".join(rendered)
+
+    def convert(self, converter: Callable[[str], str]) -> "ReplyTemplate":
+        # Convert the template (e.g. from HTML to text) once, keeping its
+        # placeholders, so rendering converted content stays cheap
+        markers = [f"WAFFLESFIELD{i}X" for i in range(len(self._names))]
+        marked = [self._literals[0]]
+        for marker, literal in zip(markers, self._literals[1:]):
+            marked.extend((marker, literal))
+        converted = converter("".join(marked))
+        for marker, name in zip(markers, self._names):
+            converted = converted.replace(marker, f"{{{{ {name} }}}}")
+        return ReplyTemplate(converted, escape=False)
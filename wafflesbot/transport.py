@@ -0,0 +1,78 @@
+import importlib
+from collections.abc import Mapping
+from typing import Any, Optional, Union
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+MAX_CONNECTIONS = 10
+
+Timeout = Union[None, float, tuple[Optional[float], Optional[float]]]
+
+
+def make_adapter(
+    max_connections: int = MAX_CONNECTIONS, http2: bool = False
+) -> BaseAdapter:
+    # Connections are kept alive and reused between requests, and callers
+    # wait for a free connection once max_connections requests are in flight
+    if http2:
+        return HTTP2Adapter(max_connections=max_connections)
+    return HTTPAdapter(
+        pool_connections=1, pool_maxsize=max_connections, pool_block=True
+    )
+
+
+class HTTP2Adapter(BaseAdapter):
+    def __init__(self, max_connections: int = MAX_CONNECTIONS) -> None:
+        super().__init__()
+        try:
+            httpx = importlib.import_module("httpx")
+        except ImportError as e:
+            raise Exception(
+                'HTTP/2 requires httpx, install "wafflesbot[http2]"'
+            ) from e
+        self._httpx: Any = httpx
+        self._client: Any = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+
+    def send(
+        self,
+        request: requests.PreparedRequest,
+        stream: bool = False,
+        timeout: Timeout = None,
+        verify: Union[bool, str] = True,
+        cert: Any = None,
+        proxies: Optional[Mapping[str, str]] = None,
+    ) -> requests.Response:
+        # Requests are always read in full, as with stream=False, and wait
+        # for a free connection as long as needed, as with HTTPAdapter
+        connect, read = (
+            timeout if isinstance(timeout, tuple) else 2 * (timeout,)
+        )
+        r = self._client.request(
+            request.method,
+            request.url,
+            headers=dict(request.headers),
+            content=request.body,
+            timeout=self._httpx.Timeout(
+                None, connect=connect, read=read, write=read, pool=None
+            ),
+        )
+        response = requests.Response()
+        response.status_code = r.status_code
+        response.headers = CaseInsensitiveDict(r.headers)
+        response._content = r.content
+        response.encoding = r.encoding
+        response.url = str(r.url)
+        response.reason = r.reason_phrase
+        response.request = request
+        return response
+
+    def close(self) -> None:
+        self._client.close()
@@ -0,0 +1,42 @@
+import threading
+from typing import Optional
+
+from .logging import log
+
+
+class SizeTuner:
+    GROWTH = 1.25
+    SMOOTHING = 0.3
+
+    def __init__(self, target_latency: float) -> None:
+        self.target_latency = target_latency
+        self._lock = threading.Lock()
+        # Smoothed response time of each kind of request, in seconds
+        self._latency: dict[str, float] = {}
+
+    def latency(self, name: str) -> Optional[float]:
+        with self._lock:
+            return self._latency.get(name)
+
+    def adjust(
+        self, name: str, size: int, elapsed: float, maximum: int
+    ) -> int:
+        # Shrink the size of slow requests in proportion to how far over the
+        # target they are, and grow it gradually while well under the target
+        with self._lock:
+            latency = self._latency.get(name, elapsed)
+            latency += self.SMOOTHING * (elapsed - latency)
+            self._latency[name] = latency
+        if latency > self.target_latency:
+            new_size = int(size * self.target_latency / latency)
+        elif latency < self.target_latency / 2:
+            new_size = max(size + 1, int(size * self.GROWTH))
+        else:
+            new_size = size
+        new_size = max(1, min(maximum, new_size))
+        if new_size != size:
+            log.debug(
+                f"Changing {name} size from {size} to {new_size} after "
+                f"{latency:.2f}s responses"
+            )
+        return new_size
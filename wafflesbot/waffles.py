@@ -1,61 +1,125 @@
 import logging
 import time
 from datetime import timedelta
-from typing import Any
+from typing import Any, Optional
 
 from jmapc import Email
 from jmapc.logging import log as jmapc_log
 
-from .jmap import JMAPClientWrapper
+from .batch import ReplyBatcher
+from .jmap import JMAPClientWrapper, Reply
 from .logging import log
-from .reply import compose_reply
+from .reply import ReplyComposer
+from .state import StateCheckpoint
+from .store import ReplyStore
+from .workers import ReplyWorkerPool
 
 
 class Waffles:
+    client_class = JMAPClientWrapper
+    _log_handler: Optional[logging.Handler] = None
+
     def __init__(
         self,
         *args: Any,
-        reply_content: str,
-        mailbox_name: str,
+        reply_content: str = "",
+        mailbox_name: Optional[str] = None,
+        mailboxes: Optional[dict[str, str]] = None,
         newer_than_days: int = 1,
+        batch_size: int = 1,
+        batch_window: float = 0.0,
+        state_file: Optional[str] = None,
+        reply_db: Optional[str] = None,
+        workers: int = 0,
+        max_queued: int = 100,
         debug: bool = False,
         **kwargs: Any,
     ):
-        self.client = JMAPClientWrapper.create_with_api_token(
+        self.client = self.client_class.create_with_api_token(
             *args,
             mailbox_name=mailbox_name,
-            new_email_callback=self._handle_email,
+            mailbox_names=list(mailboxes or {}),
+            new_email_callback=self._new_email,
+            checkpoint=(StateCheckpoint(state_file) if state_file else None),
+            reply_store=(ReplyStore(reply_db) if reply_db else None),
             **kwargs,
         )
         self.mailbox_name = mailbox_name
         self.reply_content = reply_content
+        self.composer = ReplyComposer(reply_content)
+        # Reply composers for each watched mailbox, by mailbox name
+        self.composers = {
+            name: (
+                self.composer
+                if content == reply_content
+                else ReplyComposer(content)
+            )
+            for name, content in {
+                **({mailbox_name: reply_content} if mailbox_name else {}),
+                **(mailboxes or {}),
+            }.items()
+        }
         self.newer_than_days = newer_than_days
+        self.batcher: Optional[ReplyBatcher] = None
+        if batch_size > 1 or batch_window:
+            self.batcher = ReplyBatcher(
+                self._send_replies, max_size=batch_size, window=batch_window
+            )
+        self.workers: Optional[ReplyWorkerPool] = None
+        if workers:
+            self.workers = ReplyWorkerPool(
+                self._handle_email, workers=workers, max_queued=max_queued
+            )
         self._setup_logging(debug=debug)
         jmapc_log.setLevel(logging.DEBUG if debug else logging.INFO)
 
     def run(self, limit: int = 0, events: bool = True) -> None:
-        if events:
-            self.client.process_events()
+        if self.workers is not None:
+            self.workers.start()
+        try:
+            if events:
+                self.client.process_events()
+            else:
+                self.client.process_recent_emails_without_replies(
+                    since=self._since(), limit=limit
+                )
+        finally:
+            if self.workers is not None:
+                self.workers.close()
+            if self.batcher is not None:
+                self.batcher.flush()
+            self.client.save_checkpoint()
+
+    def _since(self) -> Optional[timedelta]:
+        if not self.newer_than_days:
+            return None
+        return timedelta(days=self.newer_than_days)
+
+    def _new_email(self, email: Email) -> None:
+        if self.workers is not None:
+            self.workers.submit(email)
         else:
-            self.client.process_recent_emails_without_replies(
-                since=(
-                    timedelta(days=self.newer_than_days)
-                    if self.newer_than_days
-                    else None
-                ),
-                limit=limit,
-            )
+            self._handle_email(email)
 
     def _handle_email(self, email: Email) -> None:
         log.info(f"Email from {email.mail_from} -> {email.subject}")
         self._reply(email)
-        self.client.archive_email(email)
 
     def _reply(self, email: Email) -> None:
-        text_body, html_body, user_agent = compose_reply(
-            email, self.reply_content
+        text_body, html_body, user_agent = self._composer_for(email).compose(
+            email
         )
-        self.client.send_reply_to_email(
+        if self.batcher is not None:
+            self.batcher.add(
+                Reply(
+                    email=email,
+                    text_body=text_body,
+                    html_body=html_body,
+                    user_agent=user_agent,
+                )
+            )
+            return
+        self.client.send_reply_and_archive(
             email,
             text_body,
             html_body,
@@ -63,16 +127,31 @@ class Waffles:
             keep_sent_copy=True,
         )
 
+    def _composer_for(self, email: Email) -> ReplyComposer:
+        # Reply with the content for the first watched mailbox the email is in
+        for name, composer in self.composers.items():
+            mailbox = self.client.mailbox_by_name(name)
+            if mailbox and mailbox.id in (email.mailbox_ids or {}):
+                return composer
+        return self.composer
+
+    def _send_replies(self, replies: list[Reply]) -> None:
+        self.client.send_replies_and_archive(replies, keep_sent_copy=True)
+
     def _setup_logging(self, debug: bool) -> None:
         class UTCFormatter(logging.Formatter):
             converter = time.gmtime
 
+        log.setLevel(logging.DEBUG if debug else logging.INFO)
+        if Waffles._log_handler:
+            # Only log once when serving multiple accounts
+            return
         logger = logging.getLogger()
         handler = logging.StreamHandler()
         formatter = UTCFormatter(
-            "%(asctime)s %(name)-12s %(levelname)-8s "
+            "%(asctime)s %(name)-12s %(levelname)-8s %(threadName)s "
             "[%(filename)s:%(funcName)s:%(lineno)d] %(message)s"
         )
         handler.setFormatter(formatter)
         logger.addHandler(handler)
-        log.setLevel(logging.DEBUG if debug else logging.INFO)
+        Waffles._log_handler = handler
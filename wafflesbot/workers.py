@@ -0,0 +1,67 @@
+import queue
+import threading
+from typing import Callable, Optional
+
+from jmapc import Email
+
+from .logging import log
+
+
+class ReplyWorkerPool:
+    def __init__(
+        self,
+        handle: Callable[[Email], None],
+        workers: int = 1,
+        max_queued: int = 100,
+    ):
+        self.handle = handle
+        self.workers = workers
+        self.max_queued = max_queued
+        self._queue: queue.Queue[Optional[Email]] = queue.Queue(max_queued)
+        self._threads: list[threading.Thread] = []
+        self.start()
+
+    def start(self) -> None:
+        # Start workers, or start them again after close
+        if self._threads:
+            return
+        self._threads = [
+            threading.Thread(target=self._work, name=f"reply-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, email: Email) -> None:
+        try:
+            self._queue.put_nowait(email)
+        except queue.Full:
+            # Hold up event intake until a worker frees up queue space
+            log.warning(
+                f"Reply queue full with {self.max_queued} emails, waiting"
+            )
+            self._queue.put(email)
+        log.debug(f"Queued email {email.id}, {len(self)} emails queued")
+
+    def close(self) -> None:
+        # Let workers finish queued emails, then stop them
+        if len(self):
+            log.info(f"Waiting for {len(self)} queued emails to be handled")
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self) -> None:
+        while True:
+            email = self._queue.get()
+            if email is None:
+                return
+            try:
+                self.handle(email)
+            except Exception as e:
+                log.error(f"Error handling email {email.id}: {e}")